@@ -1,13 +1,40 @@
-import os, functools
-
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for
+import os, functools, hashlib, json, mimetypes
+from itertools import islice
+
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for, abort, send_file, stream_with_context, get_flashed_messages
+from markupsafe import Markup
+from sqlalchemy import and_, cast, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, EditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows, Timeline
+from current_user import CurrentUser
+import current_user
+import passwords
+from passwords import PasswordHasherBusy
+import query_stats
+import routing
+import metrics
+from fragments import FragmentCache
+import cache
+from profile_cards import ProfileCardCache
+import assets
+import migrations
+from pagination import (encode_cursor, keyset_page, keyset_query,
+                        merge_newest_first, merged_keyset_page)
+from search import search_users
 
 CURR_USER_KEY = "curr_user"
 
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 60
+MAX_LIKE_IDS = 200
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -18,8 +45,49 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['FRAGMENT_CACHE_BYTES'] = 32 * 1024 * 1024
+app.config['FRAGMENT_TTL'] = 24 * 60 * 60
+app.config['PROFILE_CARD_CACHE_SIZE'] = 50000
+app.config['PROFILE_CARD_TTL'] = 60
+app.config['ASSET_BUILD_FOLDER'] = os.path.join(app.static_folder, 'build')
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 60 * 60
+app.config['FAN_OUT_MAX_FOLLOWERS'] = (
+    int(os.environ['FAN_OUT_MAX_FOLLOWERS']) if os.environ.get('FAN_OUT_MAX_FOLLOWERS') else None)
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL', 'null://')
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
 
 connect_db(app)
+query_stats.init_app(app)
+routing.init_app(app)
+passwords.init_app(app)
+
+metrics_store = metrics.init_app(app)
+
+with app.app_context():
+    metrics.instrument_engine(db.engine, 'primary')
+
+metrics.registry.gauge('warbler_bcrypt_queue_depth',
+                       "Password hash/check operations queued or running.",
+                       function=passwords.queue_depth)
+
+message_fragments = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'])
+
+# shared by every worker (see cache.py)
+shared_cache = cache.from_url(app.config['CACHE_URL'])
+
+profile_cards = ProfileCardCache(app.config['PROFILE_CARD_CACHE_SIZE'],
+                                 app.config['PROFILE_CARD_TTL'])
+
+profile_card_stats = metrics.registry.gauge(
+    'warbler_profile_card_cache', "Profile card cache entries, bytes, hits and misses.",
+    labels=('stat',))
+
+for stat in ['entries', 'bytes', 'hits', 'misses']:
+    profile_card_stats.set_function(lambda stat=stat: profile_cards.stats()[stat], stat=stat)
+
+asset_manifest = assets.load_manifest(app.config['ASSET_BUILD_FOLDER'])
 
 
 ##############################################################################
@@ -44,12 +112,26 @@ def login_required(func):
     return wrapper_login_required
 
 
+def api_login_required(func):
+    """Like login_required, but answer JSON API clients with a 401."""
+    @functools.wraps(func)
+    def wrapper_api_login_required(*args, **kwargs):
+        if not g.user:
+            return jsonify(error="Login required"), 401
+        return func(*args, **kwargs)
+    return wrapper_api_login_required
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a CurrentUser: a cached snapshot of the user's basic fields
+    that only loads the full User when a route needs more.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = CurrentUser.resolve(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -117,6 +199,9 @@ def login():
         next_url = request.form.get('next')
 
         if user:
+            # save the rehashed password if the bcrypt cost has changed
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
 
@@ -149,17 +234,23 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    an 'after' cursor for the next page of results.
     """
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    try:
+        users, next_cursor = search_users(search, request.args.get('after'),
+                                          per_page=USERS_PER_PAGE)
+    except ValueError:
+        abort(400)
+
+    following_ids = g.user.following_ids([u.id for u in users]) if g.user else set()
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', users=profile_cards.add_many(users),
+                           search=search,
+                           next_cursor=next_cursor, following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>')
@@ -168,15 +259,45 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    latest = (db.session
+              .query(func.max(Message.id))
+              .filter(Message.user_id == user_id)
+              .scalar())
+
+    not_modified = check_etag(profile_validator(user), latest)
+    if not_modified:
+        return not_modified
+
+    messages, next_cursor = user_messages_page(user_id)
+    prefetch_fragments(messages, {user.id: user})
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
+
+
+@app.route('/users/<int:user_id>/messages')
+def users_messages(user_id):
+    """Next page of a user's messages, as <li> fragments for infinite scroll."""
+
+    user = profile_cards.get(user_id) or abort(404)
+    messages, next_cursor = user_messages_page(user_id, request.args.get('before'))
+    prefetch_fragments(messages, {user.id: user})
+
+    resp = app.make_response(render_template('users/message-items.html',
+                                             user=user, messages=messages))
+    return with_next_page(resp, 'users_messages', next_cursor, user_id=user_id)
+
+
+def user_messages_page(user_id, before=None):
+    """One page of a user's messages, newest first, plus the next cursor.
+
+    The template takes the author from the profile's user rather than
+    msg.user, so no author is loaded per message.
+    """
+
+    query = Message.query.filter(Message.user_id == user_id)
+
+    return paginate(query, Message.timestamp, Message.id, before)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -185,7 +306,16 @@ def show_following(user_id):
     """Show list of people this user is following."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+
+    listed = select([Follows.user_being_followed_id]).where(
+        Follows.user_following_id == user_id)
+
+    not_modified = check_etag(profile_validator(user), follow_list_validator(listed))
+    if not_modified:
+        return not_modified
+
+    return stream_template('users/following.html', user=user,
+                           users=follow_cards(listed))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -194,7 +324,16 @@ def users_followers(user_id):
     """Show list of followers of this user."""
     
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+
+    listed = select([Follows.user_following_id]).where(
+        Follows.user_being_followed_id == user_id)
+
+    not_modified = check_etag(profile_validator(user), follow_list_validator(listed))
+    if not_modified:
+        return not_modified
+
+    return stream_template('users/followers.html', user=user,
+                           users=follow_cards(listed))
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -203,7 +342,16 @@ def users_likes(user_id):
     """Show list of user's liked messages."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+
+    messages = (Message
+                .query
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .all())
+
+    return render_template('users/likes.html', user=user, messages=messages,
+                           authors=message_authors(messages))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -213,6 +361,9 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    Timeline.add_follow(g.user.id, followed_user.id)
+    User.adjust_counts([g.user.id], following_count=1)
+    User.adjust_counts([followed_user.id], followers_count=1)
     db.session.commit()
 
     return redirect(url_for("show_following", user_id=g.user.id))
@@ -225,6 +376,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    Timeline.remove_follow(g.user.id, followed_user.id)
+    User.adjust_counts([g.user.id], following_count=-1)
+    User.adjust_counts([followed_user.id], followers_count=-1)
     db.session.commit()
 
     return redirect(url_for("show_following", user_id=g.user.id))
@@ -240,7 +394,8 @@ def profile():
     if edit_form.validate_on_submit():
 
         user = User.authenticate(g.user.username,
-                                 edit_form.password.data)
+                                 edit_form.password.data,
+                                 recent_ok=True)
 
         if user:
 
@@ -250,8 +405,12 @@ def profile():
             g.user.header_image_url = edit_form.header_image_url.data
             g.user.bio = edit_form.bio.data
             g.user.location = edit_form.location.data
+            g.user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            current_user.invalidate(g.user.id)
+            profile_cards.invalidate(g.user.id)
+            message_fragments.invalidate_author(g.user.id)
 
             flash("Update Successful!", "success")
             return redirect(url_for("users_show", user_id=g.user.id))
@@ -270,8 +429,15 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+
+    g.user.release_counts()
+    db.session.delete(g.user.load())
     db.session.commit()
+    current_user.invalidate(user_id)
+    profile_cards.invalidate(user_id)
+    passwords.forget(user_id)
+    message_fragments.invalidate_author(user_id)
 
     return redirect(url_for("signup"))
 
@@ -292,6 +458,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        Timeline.fan_out(msg)
+        User.adjust_counts([g.user.id], messages_count=1)
         db.session.commit()
 
         return redirect(url_for("users_show", user_id=g.user.id))
@@ -304,36 +473,66 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message
+           .query
+           .options(db.joinedload(Message.user))
+           .get_or_404(message_id))
+
+    author = msg.user
+    follows_author = (Follows.exists(follower_id=g.user.id, followed_id=author.id)
+                      if g.user else None)
+
+    not_modified = check_etag(msg.id, author.id, author.profile_version, follows_author)
+    if not_modified:
+        return not_modified
+
+    return render_template('messages/show.html', message=msg,
+                           follows_author=follows_author)
 
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
 @login_required
 def messages_like(message_id):
-    """Like a message."""
+    """Like a message, or unlike it if already liked.
 
-    liked = Likes.query.filter_by(message_id=message_id).first()
+    Responds with the new like state and the message's like count.
+    """
 
-    if liked:
-        db.session.delete(liked)
+    try:
+        liked, like_count = Likes.toggle(g.user.id, message_id)
         db.session.commit()
 
-        likes = Likes.query.filter(Likes.user_id == g.user.id).all()
+    except IntegrityError:
+        # no such message
+        db.session.rollback()
+        abort(404)
 
-        g.user.likes = likes
+    action = "liked" if liked else "unliked"
 
-        return jsonify(message=f"Message number {message_id} unliked")
+    return jsonify(message=f"Message number {message_id} {action}",
+                   liked=liked, likes=like_count)
 
-    like = Likes(user_id=g.user.id, message_id=message_id)
 
-    db.session.add(like)
-    db.session.commit()
+@app.route('/api/likes')
+def messages_likes_summary():
+    """Like state and like count for a batch of messages.
+
+    Takes comma-separated message ids in the 'ids' param (at most
+    MAX_LIKE_IDS) and responds with {"likes": {id: {"liked", "count"}}},
+    where "liked" is for the logged-in user (always false when logged out).
+    """
+
+    try:
+        ids = {int(id) for id in request.args.get('ids', '').split(',') if id}
+    except ValueError:
+        abort(400)
 
-    likes = Likes.query.filter(Likes.user_id == g.user.id).all()
+    if len(ids) > MAX_LIKE_IDS:
+        abort(400)
 
-    g.user.likes = likes
-    return jsonify(message=f"Message number {message_id} liked")
+    summary = Likes.summary(ids, g.user.id if g.user else None)
+
+    return jsonify(likes=summary)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -347,12 +546,142 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for("homepage"))
 
+    Timeline.remove_message(msg.id)
+    msg.release_counts()
     db.session.delete(msg)
     db.session.commit()
+    message_fragments.invalidate_message(message_id)
 
     return redirect(url_for("users_show", user_id=g.user.id))
 
 
+##############################################################################
+# JSON feed API
+#
+# Feeds are streamed: rows come off a server-side cursor and are
+# serialized one at a time by a generator, so a page never exists in
+# memory as a list. Paging works like the HTML feeds: pass the "next"
+# cursor from one page as 'before' to get the following page.
+
+@app.route('/api/feed')
+@api_login_required
+def api_feed():
+    """The logged-in user's home timeline as JSON."""
+
+    return stream_feed(*home_feeds(g.user.id, feed_rows_query()))
+
+
+@app.route('/api/users/<int:user_id>/messages')
+def api_users_messages(user_id):
+    """A user's messages as JSON."""
+
+    User.query.get_or_404(user_id)
+
+    query = feed_rows_query().filter(Message.user_id == user_id)
+
+    return stream_feed((query, Message.timestamp, Message.id))
+
+
+def feed_rows_query():
+    """Plain rows (no ORM objects) for each message and its author."""
+
+    return (db.session
+            .query(Message.id, Message.text, Message.timestamp,
+                   User.id.label('user_id'), User.username, User.image_url)
+            .join(User, User.id == Message.user_id))
+
+
+def stream_feed(*feeds):
+    """Stream one keyset page as {"messages": [...], "next": cursor}.
+
+    `feeds` are (query, timestamp_col, id_col), merged newest first.
+    Takes 'before' (a cursor) and 'limit' from the query string. "next" is
+    null on the last page.
+    """
+
+    try:
+        limit = min(int(request.args.get('limit', API_PAGE_SIZE)), API_MAX_PAGE_SIZE)
+        queries = [keyset_query(query, timestamp_col, id_col, request.args.get('before'))
+                   for query, timestamp_col, id_col in feeds]
+    except ValueError:
+        abort(400)
+
+    if limit < 1:
+        abort(400)
+
+    rows = merge_newest_first([query.limit(limit + 1).yield_per(100) for query in queries])
+
+    def generate():
+        yield '{"messages":['
+
+        next_cursor = None
+        last = None
+
+        for n, row in enumerate(rows):
+            if n == limit:
+                next_cursor = encode_cursor(last.timestamp, last.id)
+                break
+
+            yield (',' if n else '') + json.dumps({
+                'id': row.id,
+                'text': row.text,
+                'timestamp': row.timestamp.isoformat(),
+                'user': {
+                    'id': row.user_id,
+                    'username': row.username,
+                    'image_url': row.image_url,
+                },
+            }, separators=(',', ':'))
+
+            last = row
+
+        yield '],"next":' + json.dumps(next_cursor) + '}'
+
+    return app.response_class(stream_with_context(generate()),
+                              mimetype='application/json')
+
+
+##############################################################################
+# Fingerprinted static assets (see assets.py; build with 'flask build-assets')
+
+@app.route('/assets/<path:filename>')
+def built_asset(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it.
+
+    Fingerprinted names change whenever content does, so responses are
+    cacheable for a year and never need revalidating.
+    """
+
+    # only names from the manifest, so the path can't escape the build folder
+    if filename not in asset_manifest.values():
+        abort(404)
+
+    path = os.path.join(app.config['ASSET_BUILD_FOLDER'], filename)
+    path, encoding = assets.choose_encoding(path, request.accept_encodings)
+
+    resp = send_file(path, mimetype=mimetypes.guess_type(filename)[0])
+
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+
+    resp.vary.add('Accept-Encoding')
+    resp.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+    g.cache_control_set = True
+
+    return resp
+
+
+##############################################################################
+# Metrics (see metrics.py)
+
+@app.route('/metrics')
+def metrics_view():
+    """Request, database pool and password hashing metrics for Prometheus."""
+
+    return app.response_class(metrics.collect(store=metrics_store),
+                              content_type=metrics.CONTENT_TYPE)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -367,31 +696,362 @@ def homepage():
 
     if g.user:
 
-        # get the ids of all accounts that the user is following
-        ids = [user.id for user in g.user.following]
-        # include the users own id
-        ids.append(g.user.id)
+        messages, next_cursor = home_feed_page(g.user.id)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        return render_template('home.html', messages=messages, next_cursor=next_cursor,
+                               authors=message_authors(messages))
 
+    else:
+        return render_template('home-anon.html')
 
-        ids = [msg.id for msg in g.user.likes]
 
-        # liked_msg_ids = [msg.id for msg in likes]
+@app.route('/feed')
+@login_required
+def homepage_feed():
+    """Next page of the home feed, as <li> fragments for infinite scroll."""
 
-        # messages = (Message.query.order_by(Message.timestamp.desc()).limit(100).all())
+    messages, next_cursor = home_feed_page(g.user.id, request.args.get('before'))
 
-        user = User.query.get_or_404(g.user.id)
+    resp = app.make_response(render_template('messages/feed-items.html',
+                                             messages=messages,
+                                             authors=message_authors(messages)))
+    return with_next_page(resp, 'homepage_feed', next_cursor)
 
-        return render_template('home.html', messages=messages, likes=ids, user=user)
 
-    else:
-        return render_template('home-anon.html')
+def home_feed_page(user_id, before=None):
+    """One page of a user's home timeline, newest first, plus the next cursor.
+
+    The timeline already holds the user's own messages and those of
+    everyone they follow, written when each message was posted, except
+    for messages posted above the fan-out threshold: those are merged in
+    here.
+    """
+
+    try:
+        return merged_keyset_page(home_feeds(user_id, Message.query), before,
+                                  per_page=MESSAGES_PER_PAGE)
+    except ValueError:
+        abort(400)
+
+
+def home_feeds(user_id, query):
+    """The feeds making up a user's home timeline, from a query on Message.
+
+    One (query, timestamp_col, id_col) for the user's Timeline rows, and
+    one for each followed author with messages that weren't fanned out
+    (see Timeline), read from the partial index on those messages. Each
+    feed is read for at most a page, so a page costs the same however
+    much the pulled authors have posted.
+    """
+
+    timeline = (query
+                .join(Timeline, Timeline.message_id == Message.id)
+                .filter(Timeline.user_id == user_id))
+
+    return ([(timeline, Timeline.timestamp, Timeline.message_id)]
+            + [(query.filter(Message.user_id == author_id, ~Message.fanned_out),
+                Message.timestamp, Message.id)
+               for author_id in Timeline.pulled_authors(user_id)])
+
+
+##############################################################################
+# Template helpers
+
+def stream_template(template_name, **context):
+    """Like render_template, but send the page as it renders.
+
+    Everything before the first list item (nav, profile header, sidebar)
+    goes out straight away, and long lists are never held in memory as
+    one string. Pair with a lazily iterated query for the list itself.
+    """
+
+    # The session is saved before the body streams, so take the flashes
+    # out of it now; base.html then gets them from the request context.
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(20)
+
+    return app.response_class(stream_with_context(stream))
+
+
+def follow_cards(listed):
+    """Profile cards of users whose ids are in the select `listed`, in batches.
+
+    Yields (card, followed) pairs, where `followed` says whether the
+    logged-in user follows them, resolved in the same query as the ids.
+    Cards older than the profile versions read here, which the page's
+    ETag covers, are refreshed.
+    """
+
+    viewer_follows = aliased(Follows)
+
+    rows = iter(db.session
+                .query(User.id, User.profile_version,
+                       viewer_follows.user_following_id.isnot(None))
+                .outerjoin(viewer_follows,
+                           and_(viewer_follows.user_being_followed_id == User.id,
+                                viewer_follows.user_following_id == g.user.id))
+                .filter(User.id.in_(listed))
+                .yield_per(100))
+
+    for batch in iter(lambda: list(islice(rows, 100)), []):
+        cards = profile_cards.get_many(
+            [user_id for user_id, version, followed in batch],
+            versions={user_id: version for user_id, version, followed in batch})
+
+        for user_id, version, followed in batch:
+            if user_id in cards:
+                yield cards[user_id], followed
+
+
+def message_authors(messages):
+    """{user id: profile card} for the authors of `messages`.
+
+    Also prefetches the messages' fragments, ready for message_fragment.
+    """
+
+    authors = profile_cards.get_many({msg.user_id for msg in messages})
+    prefetch_fragments(messages, authors)
+
+    return authors
+
+
+def fragment_key(msg, author):
+    """The shared cache key of a message's fragment."""
+
+    return f"fragment:{msg.id}:{author.profile_version}"
+
+
+def prefetch_fragments(messages, authors):
+    """Get the fragments this process lacks for `messages` from the shared cache.
+
+    One round trip for the whole page; message_fragment renders whatever
+    is still missing, and share_fragments stores it after the request.
+    """
+
+    keys = [fragment_key(msg, authors[msg.user_id]) for msg in messages
+            if (msg.id, authors[msg.user_id].profile_version) not in message_fragments]
+
+    if not keys:
+        return
+
+    try:
+        found = shared_cache.get_many(keys)
+    except cache.CacheError as e:
+        cache.logger.warning("cache error, rendering fragments: %s", e)
+        found = {}
+
+    g.setdefault('shared_fragments', {}).update(found)
+
+
+@app.template_global()
+def message_fragment(msg, author):
+    """Avatar, author, date and text markup for a message list item.
+
+    The same for every reader, so it comes from the fragment cache; the
+    per-reader like button is rendered around it on each request. Misses
+    are looked for in what prefetch_fragments got from the shared cache
+    before being rendered.
+    """
+
+    def render():
+        shared_key = fragment_key(msg, author)
+        html = g.get('shared_fragments', {}).get(shared_key)
+
+        if html is None:
+            html = render_template('messages/message-body.html', msg=msg, author=author)
+            g.setdefault('new_fragments', {})[shared_key] = html
+
+        return html
+
+    key = (msg.id, author.profile_version)
+
+    return Markup(message_fragments.get_or_render(key, msg.id, author.id, render))
+
+
+@app.template_global()
+def asset_url(filename):
+    """URL for a file under static/, fingerprinted if assets have been built."""
+
+    if filename in asset_manifest:
+        return url_for('built_asset', filename=asset_manifest[filename])
+
+    return url_for('static', filename=filename)
+
+
+# app.js reads this from base.html to batch its /api/likes requests
+app.add_template_global(MAX_LIKE_IDS, 'MAX_LIKE_IDS')
+
+
+##############################################################################
+# Pagination helpers
+
+def paginate(query, timestamp_col, id_col, before):
+    """Keyset-paginate `query`, turning a bad cursor into a 400."""
+
+    try:
+        return keyset_page(query, timestamp_col, id_col, before,
+                           per_page=MESSAGES_PER_PAGE)
+    except ValueError:
+        abort(400)
+
+
+def with_next_page(resp, endpoint, next_cursor, **values):
+    """Point the client at the next fragment page via the X-Next-Page header."""
+
+    if next_cursor:
+        resp.headers['X-Next-Page'] = url_for(endpoint, before=next_cursor, **values)
+
+    return resp
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Turn away logins and signups while the bcrypt pool is saturated."""
+
+    return ("Too many sign-ins in progress, please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
+##############################################################################
+# Conditional GET helpers
+#
+# Pages that support conditional requests build an ETag from cheap data
+# versions (profile versions, counters, latest ids) instead of from the
+# rendered page, so an unchanged page is answered with a 304 before any
+# template is rendered.
+
+def check_etag(*parts):
+    """Validate the request against an ETag built from `parts`.
+
+    The ETag also covers the URL and the logged-in user shown in the nav.
+    Returns a 304 response if the client's copy is current, else None;
+    either way add_header sends the ETag with the response.
+    """
+
+    viewer = (g.user.id, g.user.username, g.user.image_url) if g.user else None
+    key = repr((request.full_path, viewer, parts))
+
+    g.etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    # pending flash messages would be lost on a 304
+    if g.etag in request.if_none_match and not session.get('_flashes'):
+        return app.response_class(status=304)
+
+    return None
+
+
+def profile_validator(user):
+    """What the profile header of `user` depends on."""
+
+    follows = None
+
+    if g.user and g.user.id != user.id:
+        follows = Follows.exists(follower_id=g.user.id, followed_id=user.id)
+
+    return (user.id, user.profile_version, user.messages_count,
+            user.following_count, user.followers_count, user.likes_count,
+            follows)
+
+
+def follow_list_validator(listed):
+    """What a list of user cards depends on, given a select of their ids.
+
+    Covers who is listed, their profile versions, and which of them the
+    logged-in user follows, as two md5 digests of the ids in order.
+    """
+
+    card = func.concat(User.id, ':', User.profile_version)
+
+    cards = (db.session
+             .query(func.md5(func.string_agg(card, aggregate_order_by(',', User.id))))
+             .filter(User.id.in_(listed))
+             .scalar())
+
+    followed_id = Follows.user_being_followed_id
+
+    followed = (db.session
+                .query(func.md5(func.string_agg(cast(followed_id, db.Text),
+                                                aggregate_order_by(',', followed_id))))
+                .filter(Follows.user_following_id == g.user.id,
+                        followed_id.in_(listed))
+                .scalar())
+
+    return cards, followed
+
+
+##############################################################################
+# Command line tools
+#
+# Run these like:
+#
+#    FLASK_APP=app.py flask rebuild-timelines
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Backfill the home timelines from existing messages and follows."""
+
+    count = Timeline.rebuild()
+    db.session.commit()
+
+    click.echo(f"Rebuilt timelines: {count} entries.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Rebuild the per-user message/follow/like counters from the base tables."""
+
+    count = User.reconcile_counts()
+    db.session.commit()
+
+    click.echo(f"Reconciled counters; users corrected: {count}.")
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress static files for long-lived caching."""
+
+    manifest = assets.build(app.static_folder, app.config['ASSET_BUILD_FOLDER'])
+
+    asset_manifest.clear()
+    asset_manifest.update(manifest)
+
+    click.echo(f"Built assets: {len(manifest)} files.")
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Add indexes from models.py missing from the database (see migrations.py)."""
+
+    applied = migrations.migrate(db.engine, report=click.echo)
+
+    click.echo(f"Applied migrations: {len(applied)}.")
+
+
+@app.cli.command('explain-indexes')
+@click.option('--user-id', type=int, help="User to query for (default: most messages).")
+@click.option('--runs', default=5, help="EXPLAIN ANALYZE runs per query.")
+@click.option('--out', type=click.Path(), help="Save the results as JSON.")
+def explain_indexes(user_id, runs, out):
+    """Compare query plans with and without the feed and graph indexes.
+
+    Drops and rebuilds those indexes: use a scratch database.
+    """
+
+    results = migrations.explain_indexes(db.engine, user_id=user_id, runs=runs)
+
+    for name, phases in results.items():
+        click.echo(name)
+
+        for phase, summary in phases.items():
+            click.echo(f"  {phase:>6}: {summary['median_ms']:>9.3f} ms  "
+                       f"{' > '.join(summary['plan'])}")
+
+    if out:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=2)
 
 
 ##############################################################################
@@ -400,13 +1060,42 @@ def homepage():
 #   handled elsewhere)
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+#
+# Fingerprinted assets are exempt (see built_asset).
+#
+# Pages with an ETag (see check_etag) may be stored by the browser, but
+# must be revalidated on every use; they differ per user, so only the
+# browser's private cache may keep them.
+
+@app.after_request
+def share_fragments(resp):
+    """Store the fragments rendered for this request in the shared cache."""
+
+    if g.get('new_fragments'):
+        try:
+            shared_cache.set_many(g.new_fragments, ttl=app.config['FRAGMENT_TTL'])
+        except cache.CacheError as e:
+            cache.logger.warning("cache error, fragments not shared: %s", e)
+
+    return resp
+
 
 @app.after_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # fingerprinted assets set their own, long-lived caching headers
+    if g.get('cache_control_set'):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
+
+    if g.get('etag'):
+        req.set_etag(g.etag)
+        req.headers['Cache-Control'] = 'private, no-cache'
+        req.vary.add('Cookie')
+
     return req
@@ -0,0 +1,140 @@
+"""Fingerprinted static assets.
+
+`build()` copies every file under static/ into a build folder with a
+content hash in its name (style.css -> style.1a2b3c4d5e6f.css), writes
+gzip and, when the brotli package is installed, brotli variants of text
+files, and records the mapping in manifest.json. Stylesheets are built
+last, with their url("/static/...") references rewritten to the
+fingerprinted files.
+
+Because a fingerprinted URL never changes content, it can be cached by
+browsers and proxies for a year. Templates get those URLs from
+asset_url(); without a build, it falls back to the plain /static URL.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+
+# file types worth precompressing; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+# (Accept-Encoding token, file suffix), in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+CSS_STATIC_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+def fingerprint(data):
+    """Short hex digest of `data`."""
+
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def static_files(static_folder, build_folder):
+    """Names of the files under `static_folder`, stylesheets last."""
+
+    names = []
+
+    for root, dirs, files in os.walk(static_folder):
+        # don't fingerprint a previous build
+        dirs[:] = [d for d in dirs
+                   if os.path.abspath(os.path.join(root, d)) != os.path.abspath(build_folder)]
+
+        for filename in files:
+            path = os.path.relpath(os.path.join(root, filename), static_folder)
+            names.append(path.replace(os.sep, '/'))
+
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def build(static_folder, build_folder, url_prefix='/assets/'):
+    """Fingerprint and precompress everything in `static_folder`.
+
+    `url_prefix` is where the build folder is served, used when
+    rewriting stylesheet references. Returns the manifest:
+    {original name: fingerprinted name}, with names relative to their
+    folders and using forward slashes.
+    """
+
+    manifest = {}
+
+    def built_url(match):
+        quote, name = match.groups()
+        if name not in manifest:
+            return match.group(0)
+        return f"url({quote}{url_prefix}{manifest[name]}{quote})"
+
+    for name in static_files(static_folder, build_folder):
+        with open(os.path.join(static_folder, name), 'rb') as f:
+            data = f.read()
+
+        stem, ext = os.path.splitext(name)
+
+        if ext.lower() == '.css':
+            data = CSS_STATIC_URL.sub(built_url, data.decode('utf-8')).encode('utf-8')
+
+        built_name = f"{stem}.{fingerprint(data)}{ext}"
+        target = os.path.join(build_folder, built_name)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        with open(target, 'wb') as f:
+            f.write(data)
+
+        if ext.lower() in COMPRESSIBLE:
+            compress(target, data)
+
+        manifest[name] = built_name
+
+    with open(os.path.join(build_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def compress(path, data):
+    """Write .gz (and .br, if available) copies of `data` next to `path`."""
+
+    # mtime=0 keeps the output identical between builds
+    with gzip.GzipFile(path + '.gz', 'wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+def load_manifest(build_folder):
+    """Read the manifest written by build(), or {} if there's no build."""
+
+    try:
+        with open(os.path.join(build_folder, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def choose_encoding(path, accept_encodings):
+    """Pick the best precompressed variant of `path` the client accepts.
+
+    `accept_encodings` is the request's Accept-Encoding. Returns
+    (file to send, Content-Encoding or None).
+    """
+
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] and os.path.exists(path + suffix):
+            return path + suffix, encoding
+
+    return path, None
@@ -0,0 +1,472 @@
+"""Replay traffic against Warbler and report latency per route.
+
+    python benchmark.py --mix 2000 --concurrency 8 --out before.json
+    python benchmark.py --log traffic.jsonl --target serve --out after.json
+    python benchmark.py --mix 2000 --compare before.json
+
+Requests come either from a log, one JSON object per line:
+
+    {"method": "POST", "path": "/users/add_like/12", "user_id": 3}
+    {"method": "POST", "path": "/messages/new", "user_id": 3, "data": {"text": "hi"}}
+
+or from a generated mix of home, profile, like, follow and post traffic
+over users and messages sampled from the database (see DEFAULT_MIX).
+Requests with a user_id are sent logged in as that user, using a signed
+session cookie rather than a login, so bcrypt doesn't dominate the run.
+
+Targets:
+
+- test (default): the Flask test client, in this process.
+- serve: a threaded WSGI server started in this process.
+- an http://host:port URL: a server started elsewhere. It must share this
+  app's SECRET_KEY and have WTF_CSRF_ENABLED off for posts to succeed.
+
+Results give latency percentiles, throughput and SQL queries per request
+for each route (Flask endpoint), and can be saved as JSON and compared
+with an earlier run. Latencies only cover successful (2xx and 3xx)
+responses; error statuses and exceptions raised while sending are
+counted separately. Over HTTP, query counts come from the Server-Timing
+header (see query_stats.py), which streamed responses don't send.
+"""
+
+import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+import http.client
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from sqlalchemy import event, func
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+import query_stats
+
+Request = namedtuple('Request', ['method', 'path', 'user_id', 'data'])
+Result = namedtuple('Result', ['route', 'status', 'seconds', 'queries', 'exception'])
+
+# relative weights of each kind of generated request
+DEFAULT_MIX = {'home': 50, 'profile': 25, 'like': 15, 'follow': 5, 'post': 5}
+
+SAMPLE_SIZE = 1000
+
+
+##############################################################################
+# Request sources
+
+def load_log(path):
+    """Read Requests from a JSON-lines log, skipping lines without a path."""
+
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line) if line.strip() else {}
+
+            if 'path' in entry:
+                yield Request(entry.get('method', 'GET').upper(), entry['path'],
+                              entry.get('user_id'), entry.get('data'))
+
+
+def generate_mix(count, mix=DEFAULT_MIX, seed=0):
+    """Build `count` Requests, picking each kind in proportion to `mix`.
+
+    Follow requests alternate between following and unfollowing each
+    pair, starting from the pair's current state, so that replaying them
+    in order never follows someone twice.
+    """
+
+    rng = random.Random(seed)
+
+    with app.app_context():
+        user_ids = [id for id, in db.session.query(User.id)
+                    .order_by(func.random()).limit(SAMPLE_SIZE)]
+        message_ids = [id for id, in db.session.query(Message.id)
+                       .order_by(func.random()).limit(SAMPLE_SIZE)]
+
+        if len(user_ids) < 2:
+            raise ValueError("need at least two users to generate traffic")
+
+        kinds = [kind for kind in mix if mix[kind] and (message_ids or kind != 'like')]
+        following = {}
+        requests = []
+
+        for i in range(count):
+            kind = rng.choices(kinds, [mix[kind] for kind in kinds])[0]
+            user_id = rng.choice(user_ids)
+
+            if kind == 'home':
+                requests.append(Request('GET', '/', user_id, None))
+
+            elif kind == 'profile':
+                requests.append(Request('GET', f'/users/{rng.choice(user_ids)}', user_id, None))
+
+            elif kind == 'like':
+                requests.append(Request('POST', f'/users/add_like/{rng.choice(message_ids)}',
+                                        user_id, None))
+
+            elif kind == 'follow':
+                other_id = rng.choice([id for id in user_ids[:50] if id != user_id])
+                pair = (user_id, other_id)
+
+                if pair not in following:
+                    following[pair] = Follows.exists(follower_id=user_id, followed_id=other_id)
+
+                action = 'stop-following' if following[pair] else 'follow'
+                following[pair] = not following[pair]
+                requests.append(Request('POST', f'/users/{action}/{other_id}', user_id, None))
+
+            elif kind == 'post':
+                requests.append(Request('POST', '/messages/new', user_id,
+                                        {'text': f"Benchmark message {i}"}))
+
+    return requests
+
+
+def route_for(request):
+    """The Flask endpoint `request` is routed to, or 'unknown'."""
+
+    try:
+        endpoint, _ = (app.url_map.bind('localhost')
+                       .match(urlsplit(request.path).path, request.method))
+    except HTTPException:
+        return 'unknown'
+
+    return endpoint
+
+
+def session_cookie(user_id):
+    """A Cookie header value logging the client in as `user_id`."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+##############################################################################
+# Targets: each hands out per-thread senders of Request -> (status, queries)
+
+class TestClientTarget:
+    """Requests through the Flask test client, in this thread.
+
+    SQL queries are counted with engine events, per calling thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _count(self, *args, **kwargs):
+        self._local.queries = getattr(self._local, 'queries', 0) + 1
+
+    @contextmanager
+    def running(self):
+        with app.app_context():
+            engine = db.engine
+
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+        try:
+            yield
+        finally:
+            event.remove(engine, 'before_cursor_execute', self._count)
+
+    def sender(self):
+        client = app.test_client(use_cookies=False)
+
+        def send(request):
+            self._local.queries = 0
+            headers = {'Cookie': session_cookie(request.user_id)} if request.user_id else {}
+
+            resp = client.open(request.path, method=request.method,
+                               data=request.data, headers=headers)
+            resp.get_data()
+
+            return resp.status_code, self._local.queries
+
+        return send
+
+
+class HTTPTarget:
+    """Requests over HTTP to the server at `base_url`."""
+
+    def __init__(self, base_url):
+        self.url = urlsplit(base_url)
+
+    @contextmanager
+    def running(self):
+        yield
+
+    def sender(self):
+        conn = http.client.HTTPConnection(self.url.hostname, self.url.port)
+
+        def send(request):
+            headers = {'Cookie': session_cookie(request.user_id)} if request.user_id else {}
+            body = None
+
+            if request.data is not None:
+                body = urlencode(request.data)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+            try:
+                conn.request(request.method, request.path, body, headers)
+                resp = conn.getresponse()
+                resp.read()
+            except Exception:
+                # start the next request on a fresh connection
+                conn.close()
+                raise
+
+            return resp.status, query_stats.queries(resp.headers)
+
+        return send
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Don't log every request the benchmark makes."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@contextmanager
+def serve():
+    """Run the app on a threaded WSGI server on a free local port."""
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+##############################################################################
+# Running and reporting
+
+def run(requests, target, concurrency=1):
+    """Send `requests` through `target` from `concurrency` threads.
+
+    Returns (results, elapsed seconds). A request that raises gets a
+    Result with no status and the exception's type name.
+    """
+
+    requests = iter(requests)
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        send = target.sender()
+        done = []
+
+        while True:
+            with lock:
+                request = next(requests, None)
+
+            if request is None:
+                break
+
+            start = time.perf_counter()
+
+            try:
+                status, queries = send(request)
+                exception = None
+            except Exception as e:
+                status, queries, exception = None, None, type(e).__name__
+
+            done.append(Result(route_for(request), status,
+                               time.perf_counter() - start, queries, exception))
+
+        return done
+
+    with target.running():
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            for done in [pool.submit(worker) for i in range(concurrency)]:
+                results.extend(done.result())
+
+        elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+
+def percentile(values, p):
+    """The nearest-rank `p`th percentile of sorted `values`."""
+
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def succeeded(result):
+    """Whether `result` is a 2xx or 3xx response."""
+
+    return result.status is not None and result.status < 400
+
+
+def stats(results, elapsed):
+    """Latency, throughput and query figures for `results`.
+
+    Latencies and queries are of successful responses only; `errors`
+    counts the rest, broken down in `statuses` and `exceptions`.
+    """
+
+    ok = [result for result in results if succeeded(result)]
+    latencies = sorted(result.seconds * 1000 for result in ok)
+    queries = [result.queries for result in ok if result.queries is not None]
+
+    return {
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'statuses': dict(sorted(Counter(str(result.status) for result in results
+                                        if result.status is not None).items())),
+        'exceptions': dict(sorted(Counter(result.exception for result in results
+                                          if result.exception).items())),
+        'throughput_rps': round(len(results) / elapsed, 1) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies), 2) if latencies else None,
+        'p50_ms': round(percentile(latencies, 50), 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 2) if latencies else None,
+        'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def summarize(results, elapsed, **meta):
+    """The JSON-ready report for a run: overall and per-route stats."""
+
+    routes = {}
+
+    for result in results:
+        routes.setdefault(result.route, []).append(result)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'meta': dict(meta, commit=commit, finished=datetime.utcnow().isoformat(),
+                     elapsed_s=round(elapsed, 3)),
+        'total': stats(results, elapsed) if results else None,
+        'routes': {route: stats(route_results, elapsed)
+                   for route, route_results in sorted(routes.items())},
+    }
+
+
+def format_report(report, baseline=None):
+    """Text table of `report`, with p95 changes against `baseline` if given."""
+
+    columns = ['requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms',
+               'throughput_rps', 'queries_mean']
+    rows = [('route', *columns, 'p95 vs base')]
+    # a run with no results has no total
+    totals = [('TOTAL', report['total'])] if report['total'] else []
+
+    for route, route_stats in [*report['routes'].items(), *totals]:
+        base = (baseline['total'] if route == 'TOTAL'
+                else baseline['routes'].get(route)) if baseline else None
+        change = ''
+
+        if base and base['p95_ms'] and route_stats['p95_ms'] is not None:
+            change = f"{(route_stats['p95_ms'] / base['p95_ms'] - 1) * 100:+.0f}%"
+
+        rows.append((route, *['-' if route_stats[column] is None else route_stats[column]
+                              for column in columns], change))
+
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+
+    lines = ['  '.join(str(value).rjust(width) if i else str(value).ljust(width)
+                       for i, (value, width) in enumerate(zip(row, widths)))
+             for row in rows]
+
+    total = report['total'] or {}
+    failed = {status: count for status, count in total.get('statuses', {}).items()
+              if int(status) >= 400}
+
+    if failed:
+        lines.append("error statuses: " + ', '.join(
+            f"{status} x{count}" for status, count in failed.items()))
+
+    if total.get('exceptions'):
+        lines.append("exceptions: " + ', '.join(
+            f"{name} x{count}" for name, count in total['exceptions'].items()))
+
+    return '\n'.join(lines)
+
+
+def parse_mix(text):
+    """Turn 'home=5,post=1' into {'home': 5, 'post': 1}."""
+
+    mix = {}
+
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown request kind: {kind}")
+
+        mix[kind] = float(weight)
+
+    return mix
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Replay traffic against Warbler.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--log', help="JSON-lines request log to replay")
+    source.add_argument('--mix', type=int, metavar='COUNT',
+                        help="generate COUNT requests of mixed traffic")
+    parser.add_argument('--weights', type=parse_mix, default=DEFAULT_MIX,
+                        help="e.g. home=50,profile=25,like=15,follow=5,post=5")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--target', default='test',
+                        help="'test', 'serve' or the URL of a running server")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--out', help="save the results here as JSON")
+    parser.add_argument('--compare', help="earlier JSON results to compare with")
+
+    options = parser.parse_args(args)
+
+    requests = (list(load_log(options.log)) if options.log
+                else generate_mix(options.mix, options.weights, options.seed))
+
+    # benchmark posts don't carry CSRF tokens
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    if options.target == 'test':
+        results, elapsed = run(requests, TestClientTarget(), options.concurrency)
+    elif options.target == 'serve':
+        with serve() as url:
+            results, elapsed = run(requests, HTTPTarget(url), options.concurrency)
+    else:
+        results, elapsed = run(requests, HTTPTarget(options.target), options.concurrency)
+
+    report = summarize(results, elapsed, target=options.target,
+                       concurrency=options.concurrency,
+                       source=options.log or f"mix of {options.mix}")
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    print(format_report(report, baseline))
+
+    if options.out:
+        with open(options.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Shared cache backends.
+
+Per-process caches (fragments.py, profile_cards.py) are filled again by
+every worker. A shared cache lets one worker's work serve them all. Two
+backends have the same interface and semantics:
+
+- RedisCache: talks the Redis protocol (RESP) to a Redis-compatible
+  server. Pages fetch all their entries with one MGET and store them with
+  one pipelined round trip of SETs. Eviction is up to the server's
+  maxmemory-policy (allkeys-lru is the one to use).
+- MemoryCache: the same thing in this process, evicting least recently
+  used entries past max_entries. For tests and single-process setups:
+  each worker process would hold its own copy.
+- NullCache: caches nothing. The default, for when there's no server.
+
+Keys and values are strings; entries can expire after a TTL in seconds.
+A cache that can't be reached behaves as if empty, so the app carries on
+without it.
+
+Pick one with CACHE_URL:
+
+    null://
+    memory://?max_entries=10000
+    redis://[:password@]host[:port][/db]
+"""
+
+from collections import OrderedDict
+import logging
+import socket
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+logger = logging.getLogger('warbler.cache')
+
+
+class CacheError(Exception):
+    """An error reply from the cache server."""
+
+
+class Cache:
+    """Shared string cache; subclasses implement get_many, set_many and delete."""
+
+    def get(self, key):
+        """The value for `key`, or None if it isn't cached."""
+
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` for `key`, for `ttl` seconds if given."""
+
+        self.set_many({key: value}, ttl)
+
+    def get_many(self, keys):
+        """{key: value} for those of `keys` that are cached."""
+
+        raise NotImplementedError
+
+    def set_many(self, mapping, ttl=None):
+        """Cache every key and value of `mapping`, for `ttl` seconds if given."""
+
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        """Drop `keys` from the cache."""
+
+        raise NotImplementedError
+
+
+class NullCache(Cache):
+    """A cache that stores nothing, so every lookup misses."""
+
+    def get_many(self, keys):
+        return {}
+
+    def set_many(self, mapping, ttl=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+class MemoryCache(Cache):
+    """In-process cache with Redis semantics, capped at `max_entries`."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()   # key -> (expires or None, value)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+
+                if entry is None:
+                    continue
+
+                if entry[0] is not None and entry[0] <= now:
+                    del self._entries[key]
+                    continue
+
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries[key] = (expires, str(value))
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(Cache):
+    """Cache on a Redis-compatible server, one connection per thread."""
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=1.0):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+
+        self._local = threading.local()
+
+    def get_many(self, keys):
+        keys = list(keys)
+
+        if not keys:
+            return {}
+
+        values = self._execute([['MGET', *keys]], default=[[]])[0]
+
+        return {key: value.decode('utf-8')
+                for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, mapping, ttl=None):
+        expiry = ['PX', int(ttl * 1000)] if ttl else []
+
+        self._execute([['SET', key, value, *expiry] for key, value in mapping.items()])
+
+    def delete(self, *keys):
+        if keys:
+            self._execute([['DEL', *keys]])
+
+    def _execute(self, commands, default=None):
+        """Send `commands` in one pipelined round trip; return their replies.
+
+        On a connection failure, logs it and returns `default`.
+        """
+
+        if not commands:
+            return []
+
+        try:
+            conn = self._connection()
+            conn.sendall(b''.join(encode_command(command) for command in commands))
+
+            replies = [read_reply(self._local.reader) for command in commands]
+        except OSError as e:
+            logger.warning("cache unavailable: %s", e)
+            self._disconnect()
+
+            return default
+
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+
+        return replies
+
+    def _connection(self):
+        if getattr(self._local, 'conn', None) is None:
+            conn = socket.create_connection(self.address, self.timeout)
+            self._local.conn = conn
+            self._local.reader = conn.makefile('rb')
+
+            setup = ([['AUTH', self.password]] if self.password else []) + (
+                [['SELECT', self.db]] if self.db else [])
+
+            if setup:
+                conn.sendall(b''.join(encode_command(command) for command in setup))
+
+                for reply in [read_reply(self._local.reader) for command in setup]:
+                    if isinstance(reply, CacheError):
+                        self._disconnect()
+                        raise reply
+
+        return self._local.conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+
+        if conn is not None:
+            conn.close()
+
+
+def encode_command(args):
+    """A command as a RESP array of bulk strings."""
+
+    parts = [b'*%d\r\n' % len(args)]
+
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    """Read one RESP reply from the file `reader`.
+
+    Bulk strings come back as bytes (None for a nil reply), and error
+    replies as CacheError instances, so that the rest of a pipeline's
+    replies can still be read.
+    """
+
+    line = reader.readline()
+
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError("connection closed by cache server")
+
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        return CacheError(rest.decode('utf-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        return None if length < 0 else reader.read(length + 2)[:-2]
+    if kind == b'*':
+        length = int(rest)
+        return None if length < 0 else [read_reply(reader) for i in range(length)]
+
+    raise ConnectionError(f"bad reply from cache server: {line!r}")
+
+
+def from_url(url):
+    """A NullCache, MemoryCache or RedisCache, as described by `url`."""
+
+    parts = urlsplit(url)
+
+    if parts.scheme == 'null':
+        return NullCache()
+
+    if parts.scheme == 'memory':
+        options = parse_qs(parts.query)
+        return MemoryCache(int(options.get('max_entries', [10000])[0]))
+
+    if parts.scheme == 'redis':
+        return RedisCache(parts.hostname or 'localhost', parts.port or 6379,
+                          db=int(parts.path.strip('/') or 0),
+                          password=unquote(parts.password) if parts.password else None)
+
+    raise ValueError(f"unknown cache URL scheme: {parts.scheme}")
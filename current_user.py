@@ -0,0 +1,127 @@
+"""Cached resolution of the logged-in user.
+
+add_user_to_g runs before every request, including JSON endpoints that
+only need the user's id. Rather than loading the full User row each
+time, keep a short-lived, per-process snapshot of the few fields most
+pages need, and only load the ORM object when a route asks for more.
+
+Snapshots expire after SNAPSHOT_TTL seconds; routes that change or
+delete a user call invalidate() so this process never serves stale data.
+Other worker processes may see the old values until the TTL runs out.
+"""
+
+from collections import OrderedDict, namedtuple
+from threading import Lock
+import time
+
+from flask import abort
+
+from models import db, User, Follows
+
+SNAPSHOT_TTL = 30
+MAX_SNAPSHOTS = 10000
+
+Snapshot = namedtuple('Snapshot', ['id', 'username', 'image_url', 'header_image_url'])
+
+_snapshots = OrderedDict()
+_lock = Lock()
+
+
+def get_snapshot(user_id):
+    """Return a Snapshot for `user_id`, or None if there is no such user."""
+
+    now = time.monotonic()
+
+    with _lock:
+        cached = _snapshots.get(user_id)
+
+        if cached and cached[0] > now:
+            _snapshots.move_to_end(user_id)
+            return cached[1]
+
+    row = (db.session
+           .query(*[getattr(User, field) for field in Snapshot._fields])
+           .filter(User.id == user_id)
+           .first())
+
+    if row is None:
+        invalidate(user_id)
+        return None
+
+    snapshot = Snapshot(*row)
+
+    with _lock:
+        _snapshots[user_id] = (now + SNAPSHOT_TTL, snapshot)
+        _snapshots.move_to_end(user_id)
+
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+
+    return snapshot
+
+
+def invalidate(user_id):
+    """Forget the cached snapshot for `user_id`."""
+
+    with _lock:
+        _snapshots.pop(user_id, None)
+
+
+def clear():
+    """Forget every cached snapshot."""
+
+    with _lock:
+        _snapshots.clear()
+
+
+class CurrentUser:
+    """The logged-in user, as seen by routes and templates through g.user.
+
+    Snapshot fields (id, username, image_url, header_image_url) are
+    answered without touching the database. Anything else, such as
+    relationships or methods, loads the User on first use and is
+    delegated to it; attribute writes go to the User too.
+    """
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', None)
+
+    @classmethod
+    def resolve(cls, user_id):
+        """Return a CurrentUser for `user_id`, or None if it doesn't exist."""
+
+        snapshot = get_snapshot(user_id)
+
+        return cls(snapshot) if snapshot else None
+
+    def load(self):
+        """Return the full User object, loading it on first use."""
+
+        if self._user is None:
+            user = User.query.get(self._snapshot.id)
+
+            if user is None:
+                invalidate(self._snapshot.id)
+                abort(404)
+
+            object.__setattr__(self, '_user', user)
+
+        return self._user
+
+    def is_following(self, other_user):
+        """Is the current user following `other_user`? Doesn't load the User."""
+
+        return Follows.exists(follower_id=self._snapshot.id, followed_id=other_user.id)
+
+    def __getattr__(self, name):
+        if self._user is None and name in Snapshot._fields:
+            return getattr(self._snapshot, name)
+
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot.id}: {self._snapshot.username}>"
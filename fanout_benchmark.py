@@ -0,0 +1,169 @@
+"""Compare fan-out thresholds: timeline writes per post against home feed reads.
+
+    python fanout_benchmark.py --thresholds none,10000,1000,100 --out fanout.json
+
+For each FAN_OUT_MAX_FOLLOWERS setting (see Timeline in models.py), over
+the users, messages and follows already in the database:
+
+- rows_per_post: timeline rows written per message posted, averaged over
+  every message in the database, i.e. the write amplification.
+- post_*_ms: time to insert and fan out a message, for authors sampled in
+  proportion to how much they post.
+- read_*_ms: time to build the first page of the home feed for randomly
+  sampled users, and pulled_mean, the followed authors merged in per read.
+
+Timelines are first rebuilt under the threshold (see Timeline.rebuild),
+which takes a while on a large database but isn't timed. Everything for
+a setting runs in one transaction that is rolled back, so the database
+is left as it was.
+"""
+
+import argparse
+import json
+import time
+
+from sqlalchemy import case, func
+
+from app import app, home_feed_page
+from benchmark import percentile
+from models import db, User, Message, Timeline
+
+DEFAULT_THRESHOLDS = [None, 10000, 1000, 100]
+
+
+def parse_thresholds(text):
+    """Turn 'none,1000,100' into [None, 1000, 100]."""
+
+    try:
+        return [None if part.strip().lower() == 'none' else int(part)
+                for part in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad thresholds: {text}")
+
+
+def rows_per_post(threshold):
+    """Timeline rows written per message, over all messages, at `threshold`."""
+
+    followers = User.followers_count
+
+    if threshold is not None:
+        followers = case([(followers <= threshold, followers)], else_=0)
+
+    posted, written = (db.session
+                       .query(func.sum(User.messages_count),
+                              func.sum(User.messages_count * (1 + followers)))
+                       .one())
+
+    return round(written / posted, 2) if posted else None
+
+
+def sample(posts, reads, seed=0):
+    """(author ids, reader ids) to post as and read for.
+
+    Authors are sampled from existing messages, so frequent posters come
+    up more often; readers uniformly from users.
+    """
+
+    db.session.execute("SELECT setseed(:seed)", {'seed': seed / 2 ** 31})
+
+    authors = [id for id, in db.session.query(Message.user_id)
+               .order_by(func.random()).limit(posts)]
+    readers = [id for id, in db.session.query(User.id)
+               .order_by(func.random()).limit(reads)]
+
+    return authors, readers
+
+
+def measure(threshold, authors, readers):
+    """Post as each of `authors`, then read each of `readers`' home feeds."""
+
+    app.config['FAN_OUT_MAX_FOLLOWERS'] = threshold
+    post_ms = []
+    read_ms = []
+    pulled = []
+
+    try:
+        Timeline.rebuild()
+
+        for reader_id in readers:
+            pulled.append(len(Timeline.pulled_authors(reader_id)))
+
+        for n, author_id in enumerate(authors):
+            start = time.perf_counter()
+            message = Message(text=f"Fan-out benchmark {n}", user_id=author_id)
+            db.session.add(message)
+            db.session.flush()
+            Timeline.fan_out(message)
+            post_ms.append((time.perf_counter() - start) * 1000)
+
+        for reader_id in readers:
+            start = time.perf_counter()
+            home_feed_page(reader_id)
+            read_ms.append((time.perf_counter() - start) * 1000)
+    finally:
+        db.session.rollback()
+
+    post_ms.sort()
+    read_ms.sort()
+
+    return {
+        'threshold': threshold,
+        'rows_per_post': rows_per_post(threshold),
+        'post_p50_ms': round(percentile(post_ms, 50), 2) if post_ms else None,
+        'post_p95_ms': round(percentile(post_ms, 95), 2) if post_ms else None,
+        'read_p50_ms': round(percentile(read_ms, 50), 2) if read_ms else None,
+        'read_p95_ms': round(percentile(read_ms, 95), 2) if read_ms else None,
+        'read_p99_ms': round(percentile(read_ms, 99), 2) if read_ms else None,
+        'pulled_mean': round(sum(pulled) / len(pulled), 2) if pulled else None,
+    }
+
+
+def compare(thresholds=DEFAULT_THRESHOLDS, posts=200, reads=500, seed=0):
+    """measure() each of `thresholds` with the same sampled users."""
+
+    saved = app.config.get('FAN_OUT_MAX_FOLLOWERS')
+
+    with app.app_context():
+        authors, readers = sample(posts, reads, seed)
+
+        try:
+            return [measure(threshold, authors, readers) for threshold in thresholds]
+        finally:
+            app.config['FAN_OUT_MAX_FOLLOWERS'] = saved
+
+
+def format_results(results):
+    """Text table of compare() results."""
+
+    columns = list(results[0])
+    rows = [columns] + [['none' if result[column] is None and column == 'threshold'
+                         else '-' if result[column] is None else result[column]
+                         for column in columns] for result in results]
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(columns))]
+
+    return '\n'.join('  '.join(str(value).rjust(width) for value, width in zip(row, widths))
+                     for row in rows)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Compare fan-out thresholds.")
+    parser.add_argument('--thresholds', type=parse_thresholds, default=DEFAULT_THRESHOLDS,
+                        help="comma-separated follower counts; 'none' fans out to all")
+    parser.add_argument('--posts', type=int, default=200, help="messages to post per setting")
+    parser.add_argument('--reads', type=int, default=500, help="home feeds to read per setting")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="save the results here as JSON")
+
+    options = parser.parse_args(args)
+
+    results = compare(options.thresholds, options.posts, options.reads, options.seed)
+
+    print(format_results(results))
+
+    if options.out:
+        with open(options.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Cache of rendered HTML fragments.
+
+Message list items look the same to every reader apart from the like
+button, so their markup is rendered once and reused. Entries are keyed
+by whatever identifies their content (for messages: the message id and
+the author's profile version) and tagged with the message and author
+they came from, so either can be invalidated directly.
+
+The cache is per process, evicts least recently used entries, and is
+capped by the approximate memory its strings take up. Behind it, app.py
+shares fragments between processes through the shared cache (cache.py).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import sys
+
+
+class FragmentCache:
+    """LRU cache of rendered fragments with a memory cap in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()   # key -> (html, message_id, author_id)
+        self._by_message = {}           # message_id -> set of keys
+        self._by_author = {}            # author_id -> set of keys
+        self._lock = Lock()
+
+    def get_or_render(self, key, message_id, author_id, render):
+        """Return the fragment for `key`, calling `render()` on a miss."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+
+        html = render()
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (html, message_id, author_id)
+                self._by_message.setdefault(message_id, set()).add(key)
+                self._by_author.setdefault(author_id, set()).add(key)
+                self.size += sys.getsizeof(html)
+
+            while self.size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+        return html
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def invalidate_message(self, message_id):
+        """Drop every fragment rendered for `message_id`."""
+
+        with self._lock:
+            for key in list(self._by_message.get(message_id, ())):
+                self._remove(key)
+
+    def invalidate_author(self, author_id):
+        """Drop every fragment showing `author_id`'s profile."""
+
+        with self._lock:
+            for key in list(self._by_author.get(author_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        """Drop every fragment and reset the hit and miss counts."""
+
+        with self._lock:
+            self._entries.clear()
+            self._by_message.clear()
+            self._by_author.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        """Drop one entry and its index references; caller holds the lock."""
+
+        html, message_id, author_id = self._entries.pop(key)
+        self.size -= sys.getsizeof(html)
+
+        for index, tag in ((self._by_message, message_id),
+                           (self._by_author, author_id)):
+            keys = index[tag]
+            keys.discard(key)
+
+            if not keys:
+                del index[tag]
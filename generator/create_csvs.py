@@ -2,13 +2,32 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for a load test:
+
+    python generator/create_csvs.py --users 10000000 --follows 100000000 \\
+        --messages 50000000 --processes 16 --gzip --out /data/warbler
+
+Everything is made up locally (no network access), streamed to disk in
+chunks, and split across worker processes. A given --seed and --until
+always produce the same files, whatever the number of processes. Load the output with `python seed.py <out>`.
+
+Follower counts follow a power law: a user's popularity rank r gets
+followers in proportion to r ** -alpha, so a few users have a huge
+following and most have almost none. Which user gets which rank is
+shuffled, so the popular accounts aren't just the lowest ids.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import gzip
+import math
+import os
+import random
+import shutil
+from datetime import date, datetime
+from functools import partial
+from multiprocessing import Pool
+
 from faker import Faker
 from helpers import get_random_datetime
 
@@ -22,9 +41,12 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+FOLLOWER_ALPHA = 1.0
+CHUNK_SIZE = 100000
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Profile and header image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +54,230 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+    f"https://picsum.photos/seed/warbler{i}/1280/400"
     for i in range(1, 46)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+##############################################################################
+# Power-law sampling
+
+class PowerLaw:
+    """Draws user ids 1..n, rank r with probability proportional to r ** -alpha.
+
+    Sampling inverts the CDF of the continuous distribution, so it needs
+    no per-user tables. Ranks map to ids through a fixed affine shuffle
+    of 0..n-1, which is a bijection because `step` is coprime with n.
+    """
+
+    def __init__(self, n, alpha, seed):
+        self.n = n
+        self.alpha = alpha
+
+        shuffle = random.Random(seed)
+        self.offset = shuffle.randrange(n)
+        self.step = shuffle.randrange(1, n) if n > 1 else 1
+
+        while math.gcd(self.step, n) != 1:
+            self.step += 1
+
+    def rank(self, u):
+        """The rank (1..n) at quantile `u` in [0, 1)."""
+
+        if self.alpha == 1:
+            x = (self.n + 1) ** u
+        else:
+            a = 1 - self.alpha
+            x = (((self.n + 1) ** a - 1) * u + 1) ** (1 / a)
+
+        return min(int(x), self.n)
+
+    def user_id(self, rank):
+        """The user id holding popularity `rank`."""
+
+        return (rank * self.step + self.offset) % self.n + 1
+
+    def sample(self, rng):
+        return self.user_id(self.rank(rng.random()))
+
+
+def out_degree(follower, num_users, num_follows):
+    """How many users `follower` follows: the follows spread evenly, exactly."""
+
+    base, extra = divmod(num_follows, num_users)
+
+    return min(base + (follower <= extra), num_users - 1)
+
+
+def followed_by(follower, count, popularity, rng):
+    """`count` distinct users for `follower` to follow, drawn by popularity."""
+
+    followed = set()
+    attempts = 0
+
+    while len(followed) < count and attempts < 20 * count:
+        user_id = popularity.sample(rng)
+        attempts += 1
+
+        if user_id != follower:
+            followed.add(user_id)
+
+    # very skewed distributions can run out of fresh popular users
+    while len(followed) < count:
+        user_id = rng.randint(1, popularity.n)
+
+        if user_id != follower:
+            followed.add(user_id)
+
+    return followed
+
+
+##############################################################################
+# Chunk writers: each writes rows [start, stop) of one file, without header
+
+def user_rows(start, stop, seed, options):
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+
+    for user_id in range(start + 1, stop + 1):
+        # the id suffix keeps usernames and emails unique at any scale
+        username = f"{fake.user_name()}{user_id}"
+
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ]
+
+
+def message_rows(start, stop, seed, options):
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+    until = datetime.combine(options.until, datetime.min.time())
+
+    for i in range(start, stop):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(now=until, rng=rng),
+            rng.randint(1, options.users),
+        ]
+
+
+def follow_rows(start, stop, seed, options):
+    """Follows for followers start..stop-1 (user ids are 1-based)."""
+
+    rng = random.Random(seed)
+    popularity = PowerLaw(options.users, options.alpha, options.seed)
+
+    for follower in range(start + 1, stop + 1):
+        count = out_degree(follower, options.users, options.follows)
+
+        for followed in sorted(followed_by(follower, count, popularity, rng)):
+            yield [followed, follower]
+
+
+KINDS = {
+    'users': (USERS_CSV_HEADERS, user_rows, lambda options: options.users),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows, lambda options: options.messages),
+    # follows are generated per follower, so chunk over users
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows, lambda options: options.users),
+}
+
+
+def open_output(path, options):
+    if options.gzip:
+        return gzip.open(path, 'wt', newline='', compresslevel=6)
+
+    return open(path, 'w', newline='')
+
+
+def write_chunk(task, options):
+    """Write one chunk to its own part file; return the part's path."""
+
+    kind, index, start, stop = task
+    rows = KINDS[kind][1]
+
+    path = os.path.join(options.out, f"{kind}.part{index:06d}")
+    seed = random.Random(f"{options.seed}:{kind}:{index}").getrandbits(32)
+
+    with open_output(path, options) as f:
+        csv.writer(f).writerows(rows(start, stop, seed, options))
+
+    return path
+
+
+def assemble(kind, parts, options):
+    """Join the header and part files, in order, into the final CSV.
+
+    Concatenated gzip members are themselves a valid gzip file, so
+    compressed parts are joined without recompressing them.
+    """
+
+    path = os.path.join(options.out, f"{kind}.csv" + ('.gz' if options.gzip else ''))
+
+    with open_output(path, options) as f:
+        csv.writer(f).writerow(KINDS[kind][0])
+
+    with open(path, 'ab') as f:
+        for part in parts:
+            with open(part, 'rb') as chunk:
+                shutil.copyfileobj(chunk, f)
+
+            os.remove(part)
+
+    return path
+
+
+def generate(options):
+    """Write users, messages and follows CSVs into options.out."""
+
+    os.makedirs(options.out, exist_ok=True)
+
+    tasks = [(kind, index, start, min(start + options.chunk_size, count(options)))
+             for kind, (headers, rows, count) in KINDS.items()
+             for index, start in enumerate(range(0, count(options), options.chunk_size))]
+
+    with Pool(options.processes) as pool:
+        parts = pool.map(partial(write_chunk, options=options), tasks, chunksize=1)
+
+    for kind in KINDS:
+        kind_parts = [part for (task_kind, *_), part in zip(tasks, parts) if task_kind == kind]
+        print(assemble(kind, kind_parts, options))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Generate Warbler sample data.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--alpha', type=float, default=FOLLOWER_ALPHA,
+                        help="power-law exponent for follower counts (0 is uniform)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="rows (or followers, for follows) per worker task")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', type=date.fromisoformat, default=date.today(),
+                        help="messages are dated in the two years before this day")
+    parser.add_argument('--gzip', action='store_true', help="write .csv.gz files")
+    parser.add_argument('--out', default='generator')
+
+    options = parser.parse_args(args)
+
+    if options.users < 2:
+        parser.error("need at least 2 users")
+
+    if options.follows > options.users * (options.users - 1):
+        parser.error("more follows than pairs of users")
+
+    return options
+
+
+if __name__ == '__main__':
+    generate(parse_args())
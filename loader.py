@@ -0,0 +1,213 @@
+"""Bulk loading of Warbler data from CSV files.
+
+load() rebuilds the schema and streams users.csv, messages.csv and
+follows.csv (or their .csv.gz variants) into the database. The first
+line of each file names the columns it holds.
+
+On Postgres the files go through COPY in fixed-size chunks, so nothing
+is parsed into Python objects and memory stays flat however big the
+files are. Tables are created bare, with only their primary key and
+unique constraints (which the load relies on to catch bad data); indexes,
+foreign keys and after_create DDL are added once the rows are in, which
+is much faster than maintaining them row by row. Other databases (e.g.
+SQLite for local hacking) fall back to batched executemany inserts.
+"""
+
+import csv
+import gzip
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime
+from sqlalchemy.schema import AddConstraint, CreateTable
+
+from models import db, User, Message, Follows, Timeline
+
+# tables loaded from CSV, in dependency order; file name is <table>.csv
+LOADED_TABLES = [User.__table__, Message.__table__, Follows.__table__]
+
+COPY_CHUNK_SIZE = 1024 * 1024   # bytes handed to COPY per read
+INSERT_BATCH_SIZE = 5000        # rows per executemany elsewhere
+
+
+def csv_path(folder, table):
+    """Path of the data file for `table`: <table>.csv or <table>.csv.gz.
+
+    Raises ValueError if both exist, as either could be the stale one.
+    """
+
+    path = os.path.join(folder, f"{table.name}.csv")
+
+    if not os.path.exists(path + '.gz'):
+        return path
+
+    if os.path.exists(path):
+        raise ValueError(f"both {path} and {path}.gz exist; remove one")
+
+    return path + '.gz'
+
+
+def open_csv(path):
+    """Open a (possibly gzipped) CSV file for reading as text."""
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_header(f, table):
+    """Read the header line of `f` and check it names columns of `table`.
+
+    Raises ValueError for unknown columns.
+    """
+
+    header = next(csv.reader([f.readline()]))
+    unknown = [name for name in header if name not in table.c]
+
+    if unknown:
+        raise ValueError(f"{table.name}: unknown columns {', '.join(unknown)}")
+
+    return header
+
+
+def copy_rows(conn, table, f, columns):
+    """Stream the rest of `f` into `table` with COPY; return the row count."""
+
+    quote = conn.dialect.identifier_preparer.quote
+    sql = (f"COPY {quote(table.name)} ({', '.join(quote(c) for c in columns)}) "
+           f"FROM STDIN WITH (FORMAT csv)")
+
+    cursor = conn.connection.cursor()
+
+    try:
+        cursor.copy_expert(sql, f, size=COPY_CHUNK_SIZE)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def insert_rows(conn, table, f, columns):
+    """Insert the rest of `f` into `table` in batches; return the row count.
+
+    Like COPY's CSV format, empty fields are loaded as NULL.
+    """
+
+    converters = {name: datetime.fromisoformat for name in columns
+                  if isinstance(table.c[name].type, DateTime)}
+
+    def convert(name, value):
+        if value == '':
+            return None
+        return converters[name](value) if name in converters else value
+
+    reader = csv.reader(f)
+    count = 0
+
+    while True:
+        batch = [{name: convert(name, value) for name, value in zip(columns, row)}
+                 for row in islice(reader, INSERT_BATCH_SIZE)]
+
+        if not batch:
+            return count
+
+        conn.execute(table.insert(), batch)
+        count += len(batch)
+
+
+def load_table(conn, table, path):
+    """Load one CSV file into `table`; return the number of rows loaded."""
+
+    with open_csv(path) as f:
+        columns = read_header(f, table)
+
+        if conn.dialect.name == 'postgresql':
+            return copy_rows(conn, table, f, columns)
+
+        return insert_rows(conn, table, f, columns)
+
+
+def create_bare(conn, table):
+    """Create `table` with its primary key but no indexes or foreign keys."""
+
+    conn.execute(CreateTable(table, include_foreign_key_constraints=[]))
+
+
+def finish_table(conn, table):
+    """Add the indexes, foreign keys and after_create DDL create_bare skipped."""
+
+    for index in table.indexes:
+        index.create(conn)
+
+    if conn.dialect.supports_alter:
+        for constraint in table.foreign_key_constraints:
+            # AddConstraint leaves the constraint out of later CREATE TABLEs
+            # (e.g. the next create_all()); put it back in afterwards
+            create_rule = constraint._create_rule
+            conn.execute(AddConstraint(constraint))
+            constraint._create_rule = create_rule
+
+    table.dispatch.after_create(table, conn, checkfirst=False,
+                                _ddl_runner=None, _is_metadata_operation=False)
+
+
+def load(folder='generator', report=print):
+    """Drop and recreate every table, then load the CSV files in `folder`.
+
+    Timelines and per-user counters are rebuilt from the loaded rows;
+    like the loaded tables, timelines get their indexes once filled.
+    Progress, with rows per second, is passed to `report` as text.
+    Returns {table name: rows loaded}.
+    """
+
+    # before dropping anything, so an ambiguous folder loses no data
+    paths = {table: csv_path(folder, table) for table in LOADED_TABLES}
+
+    db.drop_all()
+    counts = {}
+
+    with db.engine.begin() as conn:
+        for table in LOADED_TABLES:
+            create_bare(conn, table)
+
+        for table in LOADED_TABLES:
+            start = time.perf_counter()
+            counts[table.name] = load_table(conn, table, paths[table])
+            elapsed = time.perf_counter() - start
+
+            report(f"{table.name}: {counts[table.name]:,} rows in {elapsed:.1f}s "
+                   f"({counts[table.name] / max(elapsed, 1e-6):,.0f} rows/s)")
+
+        start = time.perf_counter()
+
+        for table in LOADED_TABLES:
+            finish_table(conn, table)
+
+        report(f"indexes and constraints: {time.perf_counter() - start:.1f}s")
+
+        create_bare(conn, Timeline.__table__)
+
+    # everything else (likes, ...)
+    db.create_all()
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as conn:
+            conn.execute('ANALYZE')
+
+    start = time.perf_counter()
+    # timelines leave out popular authors, so count followers first
+    User.reconcile_counts()
+    counts[Timeline.__tablename__] = Timeline.rebuild()
+    db.session.commit()
+
+    with db.engine.begin() as conn:
+        finish_table(conn, Timeline.__table__)
+
+        if conn.dialect.name == 'postgresql':
+            conn.execute(f'ANALYZE {Timeline.__tablename__}')
+
+    report(f"timelines and counters: {time.perf_counter() - start:.1f}s")
+
+    return counts
@@ -0,0 +1,401 @@
+"""Request and resource metrics in the Prometheus text format.
+
+A small in-process registry of counters, gauges and histograms, with the
+request metrics every route gets (see init_app) and pool checkout wait
+for database engines (see instrument_engine). app.py serves them at
+/metrics.
+
+With several worker processes, each has its own registry, and a scrape
+only reaches one of them. Set METRICS_DIR to a directory shared by the
+workers: each process then saves a snapshot of its metrics there (at
+most every METRICS_WRITE_INTERVAL seconds, plus just before answering a
+scrape), and /metrics merges every snapshot. Counters and histograms are
+summed across processes, including ones that have exited, so they never
+go backwards; gauges are summed across live processes only.
+"""
+
+from bisect import bisect_left
+import json
+import os
+import time
+from threading import Lock
+
+from flask import g, request
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """A named family of samples, one per combination of label values."""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels)}")
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        """{label values: value} as of now."""
+
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down: set directly, or read from a function."""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        """Read this sample by calling `function()` whenever it's collected."""
+
+        self.set(function, **labels)
+
+    def samples(self):
+        return {key: value() if callable(value) else value
+                for key, value in super().samples().items()}
+
+
+class Histogram(Metric):
+    """Observations counted into `buckets` (upper bounds), with their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts = self._values.get(key)
+
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+
+class Registry:
+    """The metrics of one process."""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self.metrics.get(metric.name)
+
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"metric {metric.name} is already registered")
+                return existing
+
+            self.metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        gauge = self._add(Gauge(name, help, labels))
+
+        if function is not None:
+            gauge.set_function(function)
+
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """JSON-ready {name: [[label values, value], ...]} of every metric."""
+
+        return {name: [[list(key), value] for key, value in metric.samples().items()]
+                for name, metric in self.metrics.items()}
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'warbler_requests_total', "Requests handled, by endpoint, method and status.",
+    ['endpoint', 'method', 'status'])
+
+REQUEST_DURATION = registry.histogram(
+    'warbler_request_duration_seconds', "Time to produce a response, by endpoint.",
+    ['endpoint'])
+
+POOL_WAIT = registry.histogram(
+    'warbler_db_pool_checkout_wait_seconds',
+    "Time spent waiting for a database connection from the pool, by engine.",
+    ['engine'], buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+
+POOL_CHECKED_OUT = registry.gauge(
+    'warbler_db_pool_checked_out', "Database connections in use, by engine.",
+    ['engine'])
+
+
+##############################################################################
+# Sharing between processes
+
+class SnapshotStore:
+    """Per-process metric snapshots in a directory shared by workers."""
+
+    def __init__(self, directory, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self._written = 0
+        self._lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def write(self, registry, force=False):
+        """Save this process's snapshot, unless one was saved very recently."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            if not force and now - self._written < self.interval:
+                return
+
+            self._written = now
+            path = self._path(os.getpid())
+
+            with open(path + '.tmp', 'w') as f:
+                json.dump(registry.snapshot(), f)
+
+            os.replace(path + '.tmp', path)
+
+    def read(self):
+        """Yield (pid, snapshot) for every saved process."""
+
+        for filename in os.listdir(self.directory):
+            pid, ext = os.path.splitext(filename)
+
+            if ext != '.json' or not pid.isdigit():
+                continue
+
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    yield int(pid), json.load(f)
+            except (OSError, ValueError):
+                # removed or being replaced while we looked
+                continue
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def merge(registry, snapshots):
+    """Combine (pid, snapshot) pairs into {name: {label values: value}}."""
+
+    merged = {name: {} for name in registry.metrics}
+
+    for pid, snapshot in snapshots:
+        live = pid == os.getpid() or pid_alive(pid)
+
+        for name, samples in snapshot.items():
+            metric = registry.metrics.get(name)
+
+            if metric is None or (metric.type == 'gauge' and not live):
+                continue
+
+            for key, value in samples:
+                key = tuple(key)
+                total = merged[name].get(key)
+
+                if total is None:
+                    merged[name][key] = value
+                elif metric.type == 'histogram':
+                    merged[name][key] = [a + b for a, b in zip(total, value)]
+                else:
+                    merged[name][key] = total + value
+
+    return merged
+
+
+##############################################################################
+# Exposition
+
+def escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(registry, samples):
+    """Prometheus text exposition of `samples` ({name: {labels: value}})."""
+
+    lines = []
+
+    for name, metric in sorted(registry.metrics.items()):
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.type}")
+
+        for key, value in sorted(samples.get(name, {}).items()):
+            if metric.type != 'histogram':
+                lines.append(f"{name}{format_labels(metric.labels, key)} {format_value(value)}")
+                continue
+
+            cumulative = 0
+
+            for bound, count in zip([*metric.buckets, float('inf')], value):
+                cumulative += count
+                le = format_labels(metric.labels, key, [('le', format_value(bound))])
+                lines.append(f"{name}_bucket{le} {cumulative}")
+
+            lines.append(f"{name}_sum{format_labels(metric.labels, key)} {format_value(value[-1])}")
+            lines.append(f"{name}_count{format_labels(metric.labels, key)} {cumulative}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def collect(registry=registry, store=None):
+    """The text exposition of this process's metrics, or of every process's."""
+
+    if store is None:
+        return render(registry, {name: metric.samples()
+                                 for name, metric in registry.metrics.items()})
+
+    store.write(registry, force=True)
+
+    return render(registry, merge(registry, store.read()))
+
+
+##############################################################################
+# Flask and SQLAlchemy hooks
+
+def init_app(app):
+    """Count and time every request to `app`; returns the snapshot store, if any."""
+
+    app.config.setdefault('METRICS_DIR', os.environ.get('METRICS_DIR'))
+    app.config.setdefault('METRICS_WRITE_INTERVAL', 1.0)
+
+    store = None
+    if app.config['METRICS_DIR']:
+        store = SnapshotStore(app.config['METRICS_DIR'],
+                              app.config['METRICS_WRITE_INTERVAL'])
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+
+        if started is None:
+            return response
+
+        # unmatched URLs share one label, so 404 probes can't add series
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+
+        def record():
+            REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, method=method, status=response.status_code)
+
+            if store is not None:
+                store.write(registry)
+
+        # a streamed body renders after this hook; time it to the end
+        if response.is_streamed:
+            response.call_on_close(record)
+        else:
+            record()
+
+        return response
+
+    return store
+
+
+def instrument_engine(engine, name):
+    """Time connection checkouts from `engine`'s pool, and report those in use.
+
+    Checkout time covers waiting for a free connection and opening a new
+    one when the pool has room to grow. engine.dispose() replaces the
+    pool, so instrument the engine again after disposing it.
+    """
+
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+
+        try:
+            return connect()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started, engine=name)
+
+    pool.connect = timed_connect
+
+    def checked_out():
+        # not every pool class keeps count
+        checkedout = getattr(engine.pool, 'checkedout', None)
+        return checkedout() if checkedout else 0
+
+    POOL_CHECKED_OUT.set_function(checked_out, engine=name)
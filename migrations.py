@@ -0,0 +1,375 @@
+"""Online schema migrations.
+
+db.create_all() only creates missing tables, so columns, keys and indexes
+added to models.py later never reach an existing database. Each migration
+here may change tables with an upgrade function, run in one transaction,
+and then names the model indexes it adds; migrate() applies the ones not
+yet applied and records them in the schema_migrations table. Upgrades
+check the schema first, so they are no-ops on a database that
+create_all() made from the current models, and together they bring a
+database from before any of them up to what create_all() makes.
+
+On Postgres, indexes are built with CREATE INDEX CONCURRENTLY, so reads
+and writes carry on while they build. A concurrent build that fails
+leaves an invalid index behind; the next run drops and rebuilds it.
+Elsewhere (SQLite) indexes are created normally. The likes primary key
+upgrade is Postgres only. As with create_all(), the trigram index for
+user search is skipped if the pg_trgm extension can't be installed.
+
+Run them with:
+
+    FLASK_APP=app.py flask migrate
+
+explain_indexes() compares query plans with and without a migration's
+indexes. It drops them first, so only point it at a scratch database,
+e.g. one filled by generator/create_csvs.py and seed.py:
+
+    FLASK_APP=app.py flask explain-indexes --out explain.json
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import statistics
+
+from sqlalchemy import (Column, DateTime, Index, MetaData, String, Table, and_, func,
+                        inspect, select, text)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+
+from models import Message, Follows, Likes, Timeline, User
+from pagination import keyset_query
+
+# indexes is a list, or a function of the connection returning one;
+# upgrade, if given, is called with a connection in a transaction
+Migration = namedtuple('Migration', ['id', 'description', 'indexes', 'upgrade'],
+                       defaults=[None])
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('id', String(100), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def model_index(model, name):
+    """The Index called `name` declared on `model`'s table."""
+
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+def has_table(conn, model):
+    """Does `model`'s table exist?"""
+
+    return model.__tablename__ in inspect(conn).get_table_names()
+
+
+def add_columns(conn, model, names):
+    """Add those of `model`'s columns `names` missing from its table.
+
+    Returns the names of the columns added.
+    """
+
+    table = model.__table__
+    existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+    added = [name for name in names if name not in existing]
+
+    for name in added:
+        ddl = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+        conn.execute(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+    return added
+
+
+def likes_primary_key(conn):
+    """Key likes on (user_id, message_id) in place of the old serial id.
+
+    The old table also made message_id unique, so a message could only
+    ever have one like.
+    """
+
+    if 'id' not in {column['name'] for column in inspect(conn).get_columns('likes')}:
+        return
+
+    conn.execute("DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL")
+    conn.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key")
+    conn.execute("ALTER TABLE likes DROP COLUMN id")
+    conn.execute("ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)")
+
+
+def user_counters(conn):
+    """Add the users' denormalized counters and fill them in."""
+
+    if add_columns(conn, User, ['messages_count', 'following_count',
+                                'followers_count', 'likes_count']):
+        User.reconcile_counts(connection=conn)
+
+
+def profile_version(conn):
+    """Add users.profile_version; existing users start at version 1."""
+
+    add_columns(conn, User, ['profile_version'])
+
+
+def message_fan_out(conn):
+    """Add messages.fanned_out, matching what timelines already hold.
+
+    Timelines used to leave out every message of authors currently over
+    FAN_OUT_MAX_FOLLOWERS and pull them all at read time. Mark those
+    messages as not fanned out and drop them from followers' timelines,
+    so that each message is in exactly one of the two places.
+    """
+
+    limit = Timeline.max_followers()
+
+    added = add_columns(conn, Message, ['fanned_out'])
+
+    # without timelines (0006 creates them), there is nothing to match
+    if added and limit is not None and has_table(conn, Timeline):
+        popular = select([User.id]).where(User.followers_count > limit)
+
+        conn.execute(Message.__table__.update()
+                     .where(Message.user_id.in_(popular))
+                     .values(fanned_out=False))
+        conn.execute(Timeline.__table__.delete()
+                     .where(and_(Timeline.author_id.in_(popular),
+                                 Timeline.user_id != Timeline.author_id)))
+
+
+def timelines_table(conn):
+    """Create the timelines table and fill it; its indexes come after."""
+
+    if has_table(conn, Timeline):
+        return
+
+    conn.execute(CreateTable(Timeline.__table__))
+    Timeline.rebuild(connection=conn)
+
+
+# models.py makes this index in after_create DDL, so as to skip it without
+# pg_trgm. Declared on a copy of the table, so create_all() doesn't see it.
+username_trigram_index = Index(
+    'ix_users_username_trgm', text('lower(username) gin_trgm_ops'),
+    postgresql_using='gin', _table=User.__table__.tometadata(MetaData()))
+
+
+def user_search_indexes(conn):
+    """The user search indexes; the trigram one only if pg_trgm installs."""
+
+    indexes = [model_index(User, 'ix_users_username_lower')]
+
+    if conn.dialect.name == 'postgresql':
+        try:
+            conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except DBAPIError:
+            return indexes
+
+        indexes.append(username_trigram_index)
+
+    return indexes
+
+
+MIGRATIONS = [
+    Migration(
+        '0001_feed_and_graph_indexes',
+        "messages by author and time; who a user follows",
+        [model_index(Message, 'ix_messages_user_id_timestamp'),
+         model_index(Follows, 'ix_follows_user_following_id')],
+    ),
+    Migration(
+        '0002_likes_primary_key',
+        "one like per user and message, keyed on both",
+        [model_index(Likes, 'ix_likes_message_id')],
+        likes_primary_key,
+    ),
+    Migration(
+        '0003_user_counters',
+        "users' message, following, follower and like counts",
+        [],
+        user_counters,
+    ),
+    Migration(
+        '0004_profile_version',
+        "users' profile version, for cache keys",
+        [],
+        profile_version,
+    ),
+    Migration(
+        '0005_message_fan_out',
+        "which messages were fanned out to followers' timelines",
+        [model_index(Message, 'ix_messages_user_id_timestamp_pulled')],
+        message_fan_out,
+    ),
+    Migration(
+        '0006_timelines',
+        "materialized home timelines",
+        [model_index(Timeline, 'ix_timelines_user_id_timestamp'),
+         model_index(Timeline, 'ix_timelines_user_id_author_id'),
+         model_index(Timeline, 'ix_timelines_message_id')],
+        timelines_table,
+    ),
+    Migration(
+        '0007_user_search_indexes',
+        "users by lowercased username, and by substring with pg_trgm",
+        user_search_indexes,
+    ),
+]
+
+
+##############################################################################
+# Applying migrations
+
+def create_index_online(conn, index):
+    """Create `index` if it doesn't exist, concurrently on Postgres.
+
+    `conn` must be in autocommit mode: CONCURRENTLY can't run inside a
+    transaction.
+    """
+
+    ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+
+    if conn.dialect.name == 'postgresql':
+        valid = conn.execute(text(
+            "SELECT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"),
+            name=index.name).scalar()
+
+        if valid is False:
+            drop_index_online(conn, index)
+
+        ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1)
+    else:
+        ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1)
+
+    conn.execute(ddl)
+
+
+def drop_index_online(conn, index):
+    """Drop `index` if it exists, concurrently on Postgres."""
+
+    concurrently = 'CONCURRENTLY ' if conn.dialect.name == 'postgresql' else ''
+    name = conn.dialect.identifier_preparer.quote(index.name)
+
+    conn.execute(f"DROP INDEX {concurrently}IF EXISTS {name}")
+
+
+def migrate(engine, report=print):
+    """Apply every migration not yet recorded; return the ids applied."""
+
+    applied_now = []
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        schema_migrations.create(conn, checkfirst=True)
+
+        applied = {id for id, in conn.execute(select([schema_migrations.c.id]))}
+
+        for migration in MIGRATIONS:
+            if migration.id in applied:
+                continue
+
+            if migration.upgrade is not None:
+                report(f"{migration.id}: upgrading tables")
+
+                with engine.begin() as transaction:
+                    migration.upgrade(transaction)
+
+            indexes = migration.indexes
+
+            if callable(indexes):
+                indexes = indexes(conn)
+
+            for index in indexes:
+                report(f"{migration.id}: creating {index.name}")
+                create_index_online(conn, index)
+
+            conn.execute(schema_migrations.insert().values(
+                id=migration.id, applied_at=datetime.utcnow()))
+            applied_now.append(migration.id)
+
+    return applied_now
+
+
+##############################################################################
+# Before/after query plans
+
+def busiest_user(conn):
+    """The id of the user with the most messages, or None."""
+
+    return conn.execute(select([Message.user_id])
+                        .group_by(Message.user_id)
+                        .order_by(func.count().desc())
+                        .limit(1)).scalar()
+
+
+def explain_queries(user_id):
+    """{name: statement} for the lookups the indexes are meant to serve."""
+
+    return {
+        'messages by user': keyset_query(
+            select([Message.id, Message.text, Message.timestamp])
+            .where(Message.user_id == user_id),
+            Message.timestamp, Message.id).limit(100),
+        'users followed by user': select([Follows.user_being_followed_id])
+            .where(Follows.user_following_id == user_id),
+        'likes by user': select([Likes.message_id])
+            .where(Likes.user_id == user_id),
+    }
+
+
+def plan_summary(conn, statement, runs):
+    """Run EXPLAIN ANALYZE `runs` times; return the plan's nodes and median time."""
+
+    sql = str(statement.compile(dialect=conn.dialect,
+                                compile_kwargs={'literal_binds': True}))
+    times = []
+
+    for i in range(runs):
+        plan = conn.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}").scalar()[0]
+        times.append(plan['Execution Time'])
+
+    nodes = []
+    stack = [plan['Plan']]
+
+    while stack:
+        node = stack.pop(0)
+        nodes.append(' '.join(filter(None, [node['Node Type'], node.get('Index Name')])))
+        stack.extend(node.get('Plans', []))
+
+    return {'plan': nodes, 'median_ms': round(statistics.median(times), 3)}
+
+
+def explain_indexes(engine, migration_id='0001_feed_and_graph_indexes', user_id=None,
+                    runs=5):
+    """Compare query plans without and with a migration's indexes (Postgres).
+
+    Drops the indexes of the migration `migration_id` (by default the one
+    the queries in explain_queries are for), explains each query,
+    rebuilds the indexes and explains again. `user_id` defaults to the
+    user with most messages. Returns {query name: {'before': summary,
+    'after': summary}}.
+    """
+
+    migration = next(migration for migration in MIGRATIONS if migration.id == migration_id)
+    results = {}
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        if user_id is None:
+            user_id = busiest_user(conn)
+
+        queries = explain_queries(user_id)
+
+        for phase in ['before', 'after']:
+            for index in migration.indexes:
+                if phase == 'before':
+                    drop_index_online(conn, index)
+                else:
+                    create_index_online(conn, index)
+
+            conn.execute('ANALYZE')
+
+            for name, statement in queries.items():
+                results.setdefault(name, {})[phase] = plan_summary(conn, statement, runs)
+
+    return results
@@ -2,11 +2,12 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, and_, case, event, exists, func, literal, or_, select, true, union_all
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import passwords
+from routing import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,28 +27,108 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key answers "who follows X"; this answers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 user_following_id, user_being_followed_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        query = cls.query.filter_by(user_being_followed_id=followed_id,
+                                    user_following_id=follower_id)
+
+        return db.session.query(query.exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
-
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
+    __tablename__ = 'likes'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+        index=True,
     )
 
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message for this user, or unlike it if already liked.
+
+        Runs as a single statement: delete the (user_id, message_id) row
+        if present, otherwise insert it, and move the user's likes_count
+        to match. Never loads the user's other likes.
+
+        Returns (liked, number of likes the message now has).
+        """
+
+        # If nothing was deleted, the like exists afterwards: either this
+        # statement inserted it, or a concurrent toggle committed it first
+        # (the conflict). The statement's snapshot doesn't see that row,
+        # so the state and count are worked out from what was deleted.
+        row = db.session.execute(db.text("""
+            WITH unliked AS (
+                DELETE FROM likes
+                WHERE user_id = :user_id AND message_id = :message_id
+                RETURNING 1
+            ), liked AS (
+                INSERT INTO likes (user_id, message_id)
+                SELECT :user_id, :message_id
+                WHERE NOT EXISTS (SELECT 1 FROM unliked)
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            ), delta AS (
+                SELECT (SELECT count(*) FROM liked)
+                     - (SELECT count(*) FROM unliked) AS n
+            ), counted AS (
+                UPDATE users SET likes_count = likes_count + (SELECT n FROM delta)
+                WHERE id = :user_id
+            )
+            SELECT NOT EXISTS (SELECT 1 FROM unliked) AS liked,
+                   (SELECT count(*) FROM likes WHERE message_id = :message_id)
+                       + CASE WHEN EXISTS (SELECT 1 FROM unliked) THEN -1 ELSE 1 END
+                       AS like_count
+        """), {'user_id': user_id, 'message_id': message_id}).first()
+
+        return row.liked, row.like_count
+
+    @classmethod
+    def summary(cls, message_ids, user_id=None):
+        """Like state and like count for a batch of messages, in one query.
+
+        Returns {message_id: {'liked': bool, 'count': int}} for every id in
+        `message_ids`; 'liked' says whether `user_id` likes the message.
+        Uses the message_id index, so it never loads the user's likes.
+        """
+
+        summary = {message_id: {'liked': False, 'count': 0}
+                   for message_id in message_ids}
+
+        if not summary:
+            return summary
+
+        rows = (db.session
+                .query(cls.message_id,
+                       func.count(),
+                       func.sum(case([(cls.user_id == user_id, 1)], else_=0)))
+                .filter(cls.message_id.in_(summary))
+                .group_by(cls.message_id))
+
+        for message_id, count, liked in rows:
+            summary[message_id] = {'liked': bool(liked), 'count': count}
+
+        return summary
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +175,47 @@ class User(db.Model):
         nullable=False,
     )
 
+    # bumped whenever the profile changes, so anything cached from the
+    # profile (like rendered message fragments) can key on it
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # denormalized counts, kept up to date by the routes that change them
+    # (see adjust_counts) and rebuilt from scratch by reconcile_counts
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade="all, delete")
 
     followers = db.relationship(
@@ -119,16 +241,37 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
+
+        A primary key lookup on follows; never loads self.followers.
+        """
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
+
+        A primary key lookup on follows; never loads self.following.
+        """
+
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` does this user follow?
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        Resolves the follow state of a whole page of users in one query;
+        returns a set so templates can test membership in constant time.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +280,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -150,25 +293,136 @@ class User(db.Model):
         return user
 
     @classmethod
-    def authenticate(cls, username, password):
+    def authenticate(cls, username, password, recent_ok=False):
         """Find user with `username` and `password`.
 
         This is a class method (call it on the class, not an individual user.)
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
+        If the stored hash uses a different bcrypt cost than configured, it
+        is replaced with a fresh hash; the caller's commit saves it.
+
+        With `recent_ok`, a password already verified for this user within
+        the re-authentication window is accepted without another bcrypt
+        check.
+
         If can't find matching user (or if password is wrong), returns False.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            if recent_ok and passwords.recently_verified(user.id, user.password, password):
+                return user
+
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
+
+                passwords.remember(user.id, user.password, password)
                 return user
 
         return False
 
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to counter columns of the users in `user_ids`.
+
+        `user_ids` may be a list of ids or a select of ids. The update is
+        done in SQL (count = count + delta), so it is safe against
+        concurrent requests and commits with the caller's transaction.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+
+        cls.query.filter(cls.id.in_(user_ids)).update(
+            values, synchronize_session=False)
+
+    def release_counts(self):
+        """Take this user out of other users' counts before deleting it."""
+
+        followers = select([Follows.user_following_id]).where(
+            Follows.user_being_followed_id == self.id)
+        followed = select([Follows.user_being_followed_id]).where(
+            Follows.user_following_id == self.id)
+
+        User.adjust_counts(followers, following_count=-1)
+        User.adjust_counts(followed, followers_count=-1)
+
+        # likes of this user's messages disappear along with the messages
+        likes_of_messages = Likes.__table__.join(Message.__table__)
+        likers = (select([Likes.user_id])
+                  .select_from(likes_of_messages)
+                  .where(Message.user_id == self.id))
+        likes_lost = (select([func.count()])
+                      .select_from(likes_of_messages)
+                      .where(Message.user_id == self.id)
+                      .where(Likes.user_id == User.id)
+                      .as_scalar())
+
+        User.query.filter(User.id.in_(likers)).update(
+            {User.likes_count: User.likes_count - likes_lost},
+            synchronize_session=False)
+
+    @classmethod
+    def reconcile_counts(cls, connection=None):
+        """Recompute every user's counters from the base tables.
+
+        Runs in the session, or on `connection` if given. Returns the
+        number of users whose counters were wrong.
+        """
+
+        # one grouped count per table, joined on, rather than a correlated
+        # count per user: the latter is a scan per user without indexes
+        sources = {
+            'messages_count': Message.user_id,
+            'following_count': Follows.user_following_id,
+            'followers_count': Follows.user_being_followed_id,
+            'likes_count': Likes.user_id,
+        }
+
+        users = cls.__table__
+        joined = users
+        columns = [users.c.id]
+
+        for name, column in sources.items():
+            counts = (select([column.label('id'), func.count().label('n')])
+                      .group_by(column)
+                      .alias())
+            joined = joined.outerjoin(counts, counts.c.id == users.c.id)
+            columns.append(func.coalesce(counts.c.n, 0).label(name))
+
+        actual = select(columns).select_from(joined).alias('actual')
+
+        update = (users.update()
+                  .where(users.c.id == actual.c.id)
+                  .where(or_(*[users.c[name] != actual.c[name] for name in sources]))
+                  .values({name: actual.c[name] for name in sources}))
+
+        return (connection or db.session).execute(update).rowcount
+
+
+# Indexes for user search (see search.py): a btree on lower(username) for
+# exact matches and ordering, plus a trigram index on Postgres so LIKE
+# '%term%' doesn't scan the whole table. Servers without the pg_trgm
+# extension still work; substring search just falls back to a scan.
+
+db.Index('ix_users_username_lower', func.lower(User.username))
+
+event.listen(User.__table__, 'after_create', DDL("""
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX ix_users_username_trgm ON users
+            USING gin (lower(username) gin_trgm_ops);
+    EXCEPTION WHEN feature_not_supported OR insufficient_privilege THEN
+        RAISE NOTICE 'pg_trgm unavailable, skipping trigram index';
+    END $$
+""").execute_if(dialect='postgresql'))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +442,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +451,221 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # False for messages left out of followers' timelines because the
+    # author was over the fan-out threshold when posting (see Timeline)
+
+    fanned_out = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+        server_default='true',
+    )
+
     user = db.relationship('User')
 
+    # a user's messages, newest first (profile pages and the feed API), and
+    # just those that followers read at request time
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 user_id, timestamp.desc(), id.desc()),
+        db.Index('ix_messages_user_id_timestamp_pulled',
+                 user_id, timestamp.desc(), id.desc(),
+                 postgresql_where=~fanned_out),
+    )
+
+    def release_counts(self):
+        """Take this message out of its author's and likers' counts."""
+
+        User.adjust_counts([self.user_id], messages_count=-1)
+        User.adjust_counts(
+            select([Likes.user_id]).where(Likes.message_id == self.id),
+            likes_count=-1)
+
+
+class Timeline(db.Model):
+    """Materialized home feed: one row per message per user who should see it.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home page is a single range read on (user_id, timestamp) instead of
+    an IN query over everyone the user follows.
+
+    Authors with more than FAN_OUT_MAX_FOLLOWERS followers (if set) would
+    write a row per follower for every message, so their messages go only
+    into their own timeline and are marked as not fanned_out. Followers
+    pull those at read time instead (see pulled_authors). The choice is
+    made per message when it is posted, so an author crossing the
+    threshold either way never loses messages from timelines; 'flask
+    rebuild-timelines' decides again for every message.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 user_id, timestamp.desc(), message_id.desc()),
+        db.Index('ix_timelines_user_id_author_id', user_id, author_id),
+    )
+
+    @staticmethod
+    def max_followers():
+        """The FAN_OUT_MAX_FOLLOWERS setting; None pushes to every follower."""
+
+        return db.get_app().config.get('FAN_OUT_MAX_FOLLOWERS')
+
+    @classmethod
+    def pulled_authors(cls, user_id):
+        """Ids of users `user_id` follows with messages that weren't fanned out."""
+
+        not_fanned_out = exists().where(and_(
+            Message.user_id == Follows.user_being_followed_id,
+            ~Message.fanned_out))
+
+        return [id for id, in db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id,
+                        Follows.user_being_followed_id != user_id,
+                        not_fanned_out)]
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to the timelines of its author and their followers.
+
+        The message must already be flushed so it has an id and timestamp.
+        If the author is over the fan-out threshold, only their own
+        timeline gets it and the message is marked as not fanned out.
+        Returns the number of timeline rows written.
+        """
+
+        limit = cls.max_followers()
+
+        if limit is not None and (db.session.query(User.followers_count)
+                                  .filter(User.id == message.user_id)
+                                  .scalar() > limit):
+            message.fanned_out = False
+
+        values = [
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp),
+        ]
+
+        author = select([literal(message.user_id)] + values)
+        rows = author
+
+        if message.fanned_out is not False:
+            rows = union_all(author, select([Follows.user_following_id] + values)
+                             .where(and_(Follows.user_being_followed_id == message.user_id,
+                                         Follows.user_following_id != message.user_id)))
+
+        return db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], rows)).rowcount
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Remove a message from every timeline it was fanned out to."""
+
+        cls.query.filter_by(message_id=message_id).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def add_follow(cls, follower_id, followed_id):
+        """Copy the messages of `followed_id` into the follower's timeline.
+
+        Only messages that were fanned out are copied; the rest are pulled
+        at read time.
+        """
+
+        # a user's own messages are always in their timeline
+        if follower_id == followed_id:
+            return
+
+        messages = select([
+            literal(follower_id),
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ]).where(and_(Message.user_id == followed_id, Message.fanned_out))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], messages))
+
+    @classmethod
+    def remove_follow(cls, follower_id, followed_id):
+        """Drop the messages of `followed_id` from the follower's timeline."""
+
+        if follower_id == followed_id:
+            return
+
+        cls.query.filter_by(user_id=follower_id, author_id=followed_id).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, connection=None):
+        """Rebuild every timeline from the messages and follows tables.
+
+        First decides again, from authors' current follower counts, which
+        messages are fanned out. Runs in the session, or on `connection`
+        if given. Returns the number of timeline rows written.
+        """
+
+        if connection is None:
+            db.session.flush()
+
+        execute = (connection or db.session).execute
+        limit = cls.max_followers()
+        messages = Message.__table__
+        pushed = true() if limit is None else User.followers_count <= limit
+
+        execute(messages.update()
+                .where(and_(messages.c.user_id == User.id,
+                            messages.c.fanned_out != pushed))
+                .values(fanned_out=pushed))
+
+        execute(cls.__table__.delete())
+
+        own = select([
+            Message.user_id,
+            Message.id,
+            Message.user_id.label('author_id'),
+            Message.timestamp,
+        ])
+        followed = select([
+            Follows.user_following_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ]).where(and_(Follows.user_being_followed_id == Message.user_id,
+                      Follows.user_following_id != Message.user_id,
+                      Message.fanned_out))
+
+        return execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            union_all(own, followed))).rowcount
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
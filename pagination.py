@@ -0,0 +1,95 @@
+"""Keyset (cursor) pagination for Warbler feeds.
+
+Pages are keyed on (timestamp, id) rather than an OFFSET, so fetching the
+next page is one bounded index scan however far back the reader goes.
+"""
+
+from datetime import datetime
+import heapq
+from itertools import islice
+
+from sqlalchemy import tuple_
+
+CURSOR_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(timestamp, id):
+    """Build an opaque cursor string pointing just past (timestamp, id)."""
+
+    return f"{timestamp.strftime(CURSOR_FORMAT)}_{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into a (timestamp, id) pair.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    timestamp, _, id = cursor.rpartition("_")
+
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+
+
+def keyset_query(query, timestamp_col, id_col, before=None):
+    """Order `query` newest first, starting just past the `before` cursor.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    if before:
+        query = query.filter(
+            tuple_(timestamp_col, id_col) < tuple_(*decode_cursor(before)))
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def keyset_page(query, timestamp_col, id_col, before=None, per_page=100):
+    """Return one page of `query`, newest first, and the cursor for the next.
+
+    `before` is a cursor from a previous page (or None for the first page).
+    The items must expose `.timestamp` and `.id` matching the key columns.
+    The returned cursor is None when there are no more pages.
+    """
+
+    items = (keyset_query(query, timestamp_col, id_col, before)
+             .limit(per_page + 1)
+             .all())
+
+    return cut_page(items, per_page)
+
+
+def merged_keyset_page(feeds, before=None, per_page=100):
+    """Like keyset_page, over several feeds merged into one.
+
+    `feeds` is a list of (query, timestamp_col, id_col). Each query is
+    read for at most one page, and the results k-way merged.
+    """
+
+    runs = [keyset_query(query, timestamp_col, id_col, before)
+            .limit(per_page + 1)
+            .all()
+            for query, timestamp_col, id_col in feeds]
+
+    return cut_page(list(islice(merge_newest_first(runs), per_page + 1)), per_page)
+
+
+def merge_newest_first(runs):
+    """Lazily merge iterables that are each sorted newest first."""
+
+    if len(runs) == 1:
+        return iter(runs[0])
+
+    return heapq.merge(*runs, key=lambda item: (item.timestamp, item.id),
+                       reverse=True)
+
+
+def cut_page(items, per_page):
+    """Split up to per_page + 1 `items` into a page and the next cursor."""
+
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    last = items[-1]
+
+    return items, encode_cursor(last.timestamp, last.id)
@@ -0,0 +1,211 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so hashing and checking run on a small,
+bounded process pool rather than in the request thread. When more than
+BCRYPT_MAX_QUEUE operations are already waiting, new ones are refused
+with PasswordHasherBusy instead of piling up behind a login burst.
+
+Only requests use the pool. CLI commands, scripts and tests run bcrypt
+in the caller: the pool's workers are spawned fresh and import the
+caller's __main__ module, so a script without an
+`if __name__ == '__main__'` guard would run again in every worker. If a
+worker dies (killed, out of memory), the pool is replaced and the
+operation retried once, then run in the caller.
+
+Settings come from the Flask config (see init_app):
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes. Stored hashes
+  with a different cost are rehashed on the next successful login.
+- BCRYPT_POOL_SIZE: worker processes; 0 runs bcrypt in the caller.
+- BCRYPT_MAX_QUEUE: operations allowed in flight before refusing more.
+- REAUTH_WINDOW: seconds during which a password that was just checked
+  is accepted again without another bcrypt round.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+from threading import Lock
+import time
+
+import bcrypt
+from flask import has_request_context
+
+logger = logging.getLogger('warbler.passwords')
+
+MAX_RECENT = 10000
+
+settings = {
+    'BCRYPT_LOG_ROUNDS': 12,
+    'BCRYPT_POOL_SIZE': os.cpu_count() or 1,
+    'BCRYPT_MAX_QUEUE': 64,
+    'REAUTH_WINDOW': 300,
+}
+
+_executor = None
+_pending = 0
+_lock = Lock()
+
+# user id -> (expires at, HMAC of the password keyed by its stored hash)
+_recent = OrderedDict()
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password operations are already queued."""
+
+
+def init_app(app):
+    """Read password hashing settings from `app.config`."""
+
+    global _executor
+
+    for key, default in settings.items():
+        settings[key] = app.config.setdefault(key, default)
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _bcrypt_hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _bcrypt_check(pw_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+def _pool():
+    """The bcrypt pool, started if need be; caller holds the lock."""
+
+    global _executor
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings['BCRYPT_POOL_SIZE'],
+            mp_context=multiprocessing.get_context('spawn'))
+
+    return _executor
+
+
+def _discard(executor):
+    """Shut down `executor` after a worker died, unless already replaced."""
+
+    global _executor
+
+    with _lock:
+        if _executor is executor:
+            _executor = None
+
+    executor.shutdown(wait=False)
+
+
+def _run(func, *args):
+    """Run `func(*args)` on the bcrypt pool and wait for the result."""
+
+    global _pending
+
+    if not settings['BCRYPT_POOL_SIZE'] or not has_request_context():
+        return func(*args)
+
+    with _lock:
+        if _pending >= settings['BCRYPT_MAX_QUEUE']:
+            raise PasswordHasherBusy()
+
+        _pending += 1
+
+    try:
+        for attempt in range(2):
+            with _lock:
+                executor = _pool()
+
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                logger.warning("bcrypt pool broken, replacing it")
+                _discard(executor)
+
+        return func(*args)
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def queue_depth():
+    """Number of password operations submitted and not yet finished."""
+
+    return _pending
+
+
+def hash_password(password):
+    """Hash `password` at the configured cost factor."""
+
+    return _run(_bcrypt_hash, password, settings['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(pw_hash, password):
+    """Does `password` match the stored bcrypt hash `pw_hash`?"""
+
+    return _run(_bcrypt_check, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Was `pw_hash` made with a different cost than the configured one?"""
+
+    try:
+        cost = int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+
+    return cost != settings['BCRYPT_LOG_ROUNDS']
+
+
+def _digest(pw_hash, password):
+    return hmac.new(pw_hash.encode('utf-8'), password.encode('utf-8'),
+                    hashlib.sha256).digest()
+
+
+def remember(user_id, pw_hash, password):
+    """Note that `password` was just verified against `pw_hash`."""
+
+    expires = time.monotonic() + settings['REAUTH_WINDOW']
+
+    with _lock:
+        _recent[user_id] = (expires, _digest(pw_hash, password))
+        _recent.move_to_end(user_id)
+
+        while len(_recent) > MAX_RECENT:
+            _recent.popitem(last=False)
+
+
+def recently_verified(user_id, pw_hash, password):
+    """Was this exact password verified for this user within REAUTH_WINDOW?
+
+    Keyed by the stored hash, so changing the password ends the window.
+    """
+
+    with _lock:
+        recent = _recent.get(user_id)
+
+    if not recent or recent[0] < time.monotonic():
+        return False
+
+    return hmac.compare_digest(recent[1], _digest(pw_hash, password))
+
+
+def forget(user_id):
+    """End the recently-authenticated window for `user_id`."""
+
+    with _lock:
+        _recent.pop(user_id, None)
@@ -0,0 +1,168 @@
+"""Cache of user profile cards.
+
+Message list items, follower and following cards and user search results
+all show the same few fields of their users. Rather than loading a User
+object for each of them on every page, keep small read-only cards of
+those fields, per process, and fetch the ones missing in one query.
+
+Cards use __slots__, so a cache of tens of thousands of them stays
+small. They expire after a TTL; routes that change or delete a user call
+invalidate() so this process never serves stale cards. Other worker
+processes may show the old card until the TTL runs out, unless the
+caller passes the profile versions it has read (e.g. for an ETag), which
+refreshes older cards.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import sys
+import time
+
+from models import db, User
+
+
+class ProfileCard:
+    """The fields of a User shown wherever the user is listed."""
+
+    FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+              'profile_version')
+
+    __slots__ = FIELDS + ('expires',)
+
+    def __init__(self, expires, *values):
+        self.expires = expires
+
+        for field, value in zip(self.FIELDS, values):
+            setattr(self, field, value)
+
+    @property
+    def nbytes(self):
+        """Approximate memory taken by the card and its strings."""
+
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, field)) for field in self.FIELDS
+            if isinstance(getattr(self, field), str))
+
+    def __repr__(self):
+        return f"<ProfileCard #{self.id}: {self.username}>"
+
+
+class ProfileCardCache:
+    """LRU cache of ProfileCards, capped by count and expiring after `ttl`."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._cards = OrderedDict()     # user id -> ProfileCard
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """The card for `user_id`, or None if there is no such user."""
+
+        return self.get_many([user_id]).get(user_id)
+
+    def get_many(self, user_ids, versions=None):
+        """{id: card} for those of `user_ids` that exist, in one query at most.
+
+        `versions`, {id: profile_version}, makes cached cards of any other
+        version count as missing.
+        """
+
+        now = time.monotonic()
+        user_ids = set(user_ids)
+        versions = versions or {}
+        cards = {}
+
+        with self._lock:
+            for user_id in user_ids:
+                card = self._cards.get(user_id)
+
+                if (card is not None and card.expires > now
+                        and versions.get(user_id, card.profile_version) == card.profile_version):
+                    self._cards.move_to_end(user_id)
+                    cards[user_id] = card
+
+            missing = user_ids - cards.keys()
+            self.hits += len(cards)
+            self.misses += len(missing)
+
+        if missing:
+            rows = (db.session
+                    .query(*[getattr(User, field) for field in ProfileCard.FIELDS])
+                    .filter(User.id.in_(missing)))
+
+            cards.update(self._store(now, rows))
+
+        return cards
+
+    def add_many(self, users):
+        """Cache cards for already loaded `users`; return the cards, in order."""
+
+        cards = self._store(time.monotonic(), (
+            [getattr(user, field) for field in ProfileCard.FIELDS] for user in users))
+
+        return list(cards.values())
+
+    def invalidate(self, user_id):
+        """Forget the card for `user_id`."""
+
+        with self._lock:
+            self._remove(user_id)
+
+    def clear(self):
+        """Forget every card and reset the hit and miss counts."""
+
+        with self._lock:
+            self._cards.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Entry count, approximate bytes, and hit rate since the last clear()."""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                'entries': len(self._cards),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+    def __len__(self):
+        return len(self._cards)
+
+    def _store(self, now, rows):
+        """Cache a card for each row of ProfileCard.FIELDS; return {id: card}."""
+
+        cards = {}
+
+        for row in rows:
+            card = ProfileCard(now + self.ttl, *row)
+            cards[card.id] = card
+
+        with self._lock:
+            for card in cards.values():
+                self._remove(card.id)
+                self._cards[card.id] = card
+                self.size += card.nbytes
+
+            while len(self._cards) > self.max_entries:
+                self._remove(next(iter(self._cards)))
+
+        return cards
+
+    def _remove(self, user_id):
+        """Drop the card for `user_id` if cached; caller holds the lock."""
+
+        card = self._cards.pop(user_id, None)
+
+        if card is not None:
+            self.size -= card.nbytes
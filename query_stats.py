@@ -0,0 +1,122 @@
+"""Per-request SQL statistics.
+
+Engine events count the statements each request runs and the time spent
+in them. Responses report the figures in a Server-Timing header, e.g.
+
+    Server-Timing: db;dur=4.1;desc="6 queries", app;dur=12.7
+
+which browser dev tools show next to the request, and every request is
+logged to the 'warbler.requests' logger as one JSON object. Streamed
+responses get no header, as it goes out before the body's queries run;
+their log line is written once the stream is finished.
+
+Set SERVER_TIMING to False to leave the header off.
+"""
+
+import json
+import logging
+import re
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.requests')
+
+SERVER_TIMING_QUERIES = re.compile(r'(?:^|,)\s*db;[^,]*desc="(\d+) quer')
+
+
+class RequestStats:
+    """SQL statements and time for the current request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.status = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def init_app(app):
+    """Collect query statistics for every request to `app`."""
+
+    app.config.setdefault('SERVER_TIMING', True)
+
+    # every engine: the primary and any read replicas
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(_start)
+    app.after_request(_add_header)
+    app.teardown_request(_log)
+
+
+def current():
+    """The RequestStats of the request being handled, if any."""
+
+    if has_request_context():
+        return g.get('query_stats')
+
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current()
+
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - context._query_started
+
+
+def _start():
+    g.query_stats = RequestStats()
+
+
+def _add_header(response):
+    stats = current()
+
+    if stats is None:
+        return response
+
+    stats.status = response.status_code
+
+    # a streamed body runs its queries after the headers are sent, so a
+    # header would undercount; the log line covers the whole stream
+    if current_app.config['SERVER_TIMING'] and not response.is_streamed:
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries", '
+            f'app;dur={stats.elapsed() * 1000:.1f}')
+
+    return response
+
+
+def _log(exc):
+    stats = current()
+
+    if stats is None:
+        return
+
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': 500 if exc is not None else stats.status,
+        'queries': stats.queries,
+        'db_ms': round(stats.db_seconds * 1000, 2),
+        'total_ms': round(stats.elapsed() * 1000, 2),
+    }))
+
+
+def queries(headers):
+    """The query count in a response's Server-Timing header, or None."""
+
+    match = SERVER_TIMING_QUERIES.search(headers.get('Server-Timing') or '')
+
+    return int(match.group(1)) if match else None
@@ -0,0 +1,97 @@
+"""Read replica routing for the database session.
+
+With SQLALCHEMY_REPLICA_URIS set (from DATABASE_REPLICA_URLS, comma
+separated), each GET, HEAD or OPTIONS request picks one replica at
+random and db.session reads from it for the whole request. Other requests, and
+anything outside a request (CLI commands, tests), use the primary, as do
+flushes, so a stray write never lands on a replica.
+
+Replicas lag behind the primary, so someone who has just posted, liked or
+followed would otherwise not see it on the next page. After a successful
+write request the user's session is pinned to the primary for
+READ_YOUR_WRITES_SECONDS.
+
+Replica engines are reported in the pool metrics as replica0, replica1...
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+
+import metrics
+
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+PIN_KEY = 'primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the request's replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('db_replica') if has_request_context() else None
+
+        if replica is not None and not self._flushing:
+            return replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_app(app):
+    """Route read-only requests to `app`'s configured replicas."""
+
+    app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('READ_YOUR_WRITES_SECONDS', 5)
+
+    set_replicas(app, app.config['SQLALCHEMY_REPLICA_URIS'])
+
+    app.before_request(choose_engine)
+    app.after_request(pin_after_write)
+
+
+def set_replicas(app, uris):
+    """Replace `app`'s replica engines with ones for `uris`."""
+
+    for engine in app.extensions.get('read_replicas', []):
+        engine.dispose()
+
+    engines = []
+
+    for i, uri in enumerate(uris):
+        engine = create_engine(uri)
+        metrics.instrument_engine(engine, f"replica{i}")
+        engines.append(engine)
+
+    app.extensions['read_replicas'] = engines
+
+
+def pinned():
+    """Has this client written recently enough that it must read the primary?"""
+
+    return session.get(PIN_KEY, 0) > time.time()
+
+
+def choose_engine():
+    replicas = current_app.extensions['read_replicas']
+
+    if replicas and request.method in READ_METHODS and not pinned():
+        g.db_replica = random.choice(replicas)
+
+
+def pin_after_write(response):
+    if (current_app.extensions['read_replicas']
+            and request.method not in READ_METHODS
+            and response.status_code < 400):
+        session[PIN_KEY] = time.time() + current_app.config['READ_YOUR_WRITES_SECONDS']
+
+    return response
@@ -0,0 +1,105 @@
+"""User search for Warbler.
+
+Matches are ranked in tiers: exact username, then username prefix, then
+username substring. Each tier is its own indexed query, ordered by
+(lower(username), id), and tiers are only run until the page is full,
+so a popular prefix never pays for the slower substring scan.
+
+On Postgres the lookups use the lower(username) btree and pg_trgm GIN
+indexes created alongside the users table (see models.py). Terms shorter
+than a trigram can't use the GIN index, so their substring tier walks
+the btree with a LIKE filter instead, stopping once the page is full.
+SQLite has no trigram index and always scans with LIKE, which gives the
+same results for local testing.
+"""
+
+from sqlalchemy import and_, func, not_, true, tuple_
+
+from models import User
+
+USERNAME = func.lower(User.username)
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in `term` so it matches literally."""
+
+    return (term
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def match_tiers(term):
+    """List the filters for each ranking tier of a search for `term`."""
+
+    if not term:
+        return [true()]
+
+    term = term.lower()
+    prefix = USERNAME.like(f"{escape_like(term)}%", escape="\\")
+    substring = USERNAME.like(f"%{escape_like(term)}%", escape="\\")
+
+    return [
+        USERNAME == term,
+        and_(prefix, USERNAME != term),
+        and_(substring, not_(prefix)),
+    ]
+
+
+def encode_cursor(tier, user):
+    """Build a cursor pointing just past `user` in ranking tier `tier`."""
+
+    return f"{tier}:{user.id}:{user.username.lower()}"
+
+
+def decode_cursor(cursor, tier_count):
+    """Turn a cursor into (tier, username, id).
+
+    Raises ValueError if malformed or if the tier isn't one of the
+    `tier_count` tiers of the search it's used with.
+    """
+
+    tier, id, username = cursor.split(":", 2)
+    tier = int(tier)
+
+    if tier not in range(tier_count):
+        raise ValueError(f"no ranking tier {tier}")
+
+    return tier, username, int(id)
+
+
+def search_users(term=None, after=None, per_page=100):
+    """Return one page of users matching `term`, best first, and the next cursor.
+
+    With no `term`, every user is listed in username order. `after` is a
+    cursor from a previous page; the returned cursor is None on the last
+    page.
+    """
+
+    tiers = match_tiers(term)
+    start, username, id = decode_cursor(after, len(tiers)) if after else (0, None, None)
+
+    found = []
+
+    for tier in range(start, len(tiers)):
+        query = User.query.filter(tiers[tier])
+
+        if tier == start and after:
+            query = query.filter(tuple_(USERNAME, User.id) > tuple_(username, id))
+
+        users = (query
+                 .order_by(USERNAME, User.id)
+                 .limit(per_page + 1 - len(found))
+                 .all())
+
+        found.extend((tier, user) for user in users)
+
+        if len(found) > per_page:
+            break
+
+    if len(found) <= per_page:
+        return [user for _, user in found], None
+
+    found = found[:per_page]
+
+    return [user for _, user in found], encode_cursor(*found[-1])
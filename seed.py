@@ -1,20 +1,16 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [folder]
 
+Loads users, messages and follows from generator/ (or `folder`); see
+loader.py.
+"""
 
-db.drop_all()
-db.create_all()
+import sys
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from app import app
+import loader
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+with app.app_context():
+    loader.load(sys.argv[1] if len(sys.argv) > 1 else 'generator')
@@ -10,35 +10,115 @@ const $body = $("body");
  * Get the LI that the message belongs to - the message is contained 
  * in data-message-id
  * 
- * Then use the id in a POST request to the server add_like route
- * Lastly, toggle the icon from thumbs up to star, or vice versa
+ * Then use the id in a POST request to the server add_like route,
+ * which toggles the like and responds with the new state.
+ * Lastly, show the new like state and count on the button
  * 
  */
 async function toggleLike(evt) {
 
     evt.preventDefault()
 
-    const $icon = $(evt.target);
-    const $button = $($icon.closest("BUTTON"))
     const $message = $(evt.target.closest("LI"));
     const $messageId = $message.data('message-id');
 
     const res = await axios.post(`/users/add_like/${$messageId}`);
 
-    console.log(res)
-
-    //toggle icon
-    if($icon.attr('class') == 'fa fa-thumbs-up') {
-        $icon.attr('class', 'fa fa-star');
-        $button.removeClass('btn-secondary');
-        $button.addClass('btn-warning');
-    } else {
-        $icon.attr('class', 'fa fa-thumbs-up');
-        $button.removeClass('btn-warning');
-        $button.addClass('btn-secondary');
+    showLikeState($message, res.data.liked, res.data.likes);
+}
+
+
+/**
+ * Show whether a message is liked, and its like count, on its like button
+ */
+function showLikeState($message, liked, count) {
+
+    const $button = $message.find("#messages-form BUTTON");
+
+    $button.find("#icon").attr('class', liked ? 'fa fa-star' : 'fa fa-thumbs-up');
+    $button.find(".like-count").text(count || '');
+    $button.toggleClass('btn-warning', liked);
+    $button.toggleClass('btn-secondary', !liked);
+}
+
+
+/**
+ * Fill in like state for every message on the page that doesn't have it yet
+ * 
+ * Messages are rendered the same for every reader, so the reader's likes
+ * and the like counts come from batched requests to /api/likes, of at
+ * most data-max-like-ids (on the body) ids each.
+ * 
+ */
+async function loadLikeStates() {
+
+    const $pending = $("#messages LI[data-message-id]").not(".likes-loaded");
+
+    if (!$pending.length) return;
+
+    const ids = $pending.map((i, li) => $(li).data('message-id')).get();
+    const batchSize = $body.data('max-like-ids');
+    $pending.addClass("likes-loaded");
+
+    const batches = [];
+
+    for (let i = 0; i < ids.length; i += batchSize) {
+        batches.push(ids.slice(i, i + batchSize));
     }
+
+    const responses = await Promise.all(batches.map(
+        batch => axios.get('/api/likes', { params: { ids: batch.join(',') } })));
+    const likes = Object.assign({}, ...responses.map(res => res.data.likes));
+
+    $pending.each((i, li) => {
+        const state = likes[$(li).data('message-id')];
+        showLikeState($(li), state.liked, state.count);
+    });
 }
 
 
 // Click event handler
 $body.on("click", "#icon", toggleLike);
+
+
+/**
+ * Infinite scroll for message lists
+ * 
+ * The message list carries the URL of its next page in data-next-page.
+ * When the reader nears the bottom of the page, fetch that page's LI
+ * fragments, append them, and take the following page's URL from the
+ * X-Next-Page response header (absent on the last page).
+ * 
+ */
+let loadingNextPage = false;
+
+async function loadNextPage() {
+
+    const $messages = $("#messages");
+    const nextPage = $messages.attr('data-next-page');
+
+    if (!nextPage || loadingNextPage) return;
+
+    loadingNextPage = true;
+
+    try {
+        const res = await axios.get(nextPage);
+
+        $messages.append(res.data);
+        $messages.attr('data-next-page', res.headers['x-next-page'] || '');
+
+        loadLikeStates();
+    } finally {
+        loadingNextPage = false;
+    }
+}
+
+
+$(window).on("scroll", function () {
+    if ($(window).scrollTop() + $(window).height() > $(document).height() - 600) {
+        loadNextPage();
+    }
+});
+
+
+$(loadLikeStates);
@@ -0,0 +1,89 @@
+"""Fingerprinted asset tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, asset_manifest
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build the static folder into a scratch build folder."""
+
+        self.build_folder = tempfile.mkdtemp()
+        self.manifest = assets.build(app.static_folder, self.build_folder)
+
+        self.patches = [
+            patch.dict(app.config, {'ASSET_BUILD_FOLDER': self.build_folder}),
+            patch.dict(asset_manifest, self.manifest, clear=True),
+        ]
+        for p in self.patches:
+            p.start()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Restore the real build settings."""
+
+        for p in reversed(self.patches):
+            p.stop()
+
+        shutil.rmtree(self.build_folder)
+
+    def test_build(self):
+        """Are files fingerprinted, precompressed and referenced from CSS?"""
+
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(self.build_folder, css + '.gz')))
+
+        # images are already compressed
+        logo = self.manifest['images/warbler-logo.png']
+        self.assertFalse(os.path.exists(os.path.join(self.build_folder, logo + '.gz')))
+
+        with open(os.path.join(self.build_folder, css)) as f:
+            self.assertIn(f'url("/assets/{self.manifest["images/nav-bg.png"]}")', f.read())
+
+        # an unchanged tree builds to the same names
+        with tempfile.TemporaryDirectory() as rebuild_folder:
+            self.assertEqual(assets.build(app.static_folder, rebuild_folder), self.manifest)
+
+    def test_serve_fingerprinted(self):
+        """Are built assets linked from pages and served with immutable caching?"""
+
+        resp = self.client.get('/login')
+        css_url = f"/assets/{self.manifest['stylesheets/style.css']}"
+        self.assertIn(f'href="{css_url}"', resp.get_data(as_text=True))
+
+        resp = self.client.get(css_url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
+
+        resp = self.client.get(css_url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b'#warbler-hero', gzip.decompress(resp.get_data()))
+        resp.close()
+
+        resp = self.client.get('/assets/../app.py')
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,127 @@
+"""Benchmark harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Message, Follows, Likes, Timeline
+import benchmark
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BenchmarkTestCase(TestCase):
+    """Test replaying traffic."""
+
+    def setUp(self):
+        """Create a couple of users with messages."""
+
+        Timeline.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        for name in ['alice', 'bob', 'carol']:
+            user = User(username=name, email=f"{name}@test.com", password="HASHED")
+            user.messages.append(Message(text=f"Hi from {name}"))
+            db.session.add(user)
+
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_generated_mix(self):
+        """Does a generated mix run cleanly and report per route?"""
+
+        requests = benchmark.generate_mix(40, seed=1)
+        self.assertEqual(len(requests), 40)
+
+        results, elapsed = benchmark.run(requests, benchmark.TestClientTarget(), concurrency=2)
+        report = benchmark.summarize(results, elapsed, target='test')
+
+        self.assertEqual(report['total']['requests'], 40)
+        self.assertEqual(report['total']['errors'], 0)
+        self.assertIn('homepage', report['routes'])
+        self.assertGreater(report['routes']['homepage']['queries_mean'], 0)
+        self.assertIn('TOTAL', benchmark.format_report(report, baseline=report))
+
+    def test_replay_log_over_http(self):
+        """Are logged requests replayed against a real server?"""
+
+        alice_id = User.query.filter_by(username='alice').one().id
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            f.write(json.dumps({"path": "/"}) + "\n\n")
+            f.write(json.dumps({"method": "POST", "path": "/messages/new",
+                                "user_id": alice_id, "data": {"text": "Replayed"}}) + "\n")
+
+        try:
+            requests = list(benchmark.load_log(f.name))
+        finally:
+            os.remove(f.name)
+
+        with benchmark.serve() as url:
+            results, elapsed = benchmark.run(requests, benchmark.HTTPTarget(url))
+
+        self.assertEqual([(r.route, r.status) for r in results],
+                         [('homepage', 200), ('messages_add', 302)])
+        self.assertEqual(Message.query.filter_by(text="Replayed").count(), 1)
+
+    def test_failures_reported_separately(self):
+        """Are exceptions and error statuses counted apart from latencies?"""
+
+        class FlakyTarget(benchmark.TestClientTarget):
+            def sender(self):
+                send = super().sender()
+
+                def flaky(request):
+                    if request.path == '/broken':
+                        raise ConnectionResetError("reset by peer")
+
+                    return send(request)
+
+                return flaky
+
+        requests = [benchmark.Request('GET', '/', None, None),
+                    benchmark.Request('GET', '/users/999999', None, None),
+                    benchmark.Request('GET', '/broken', None, None)]
+
+        results, elapsed = benchmark.run(requests, FlakyTarget())
+        report = benchmark.summarize(results, elapsed, target='test')
+
+        self.assertEqual([r.exception for r in results],
+                         [None, None, 'ConnectionResetError'])
+        self.assertEqual(report['total']['errors'], 2)
+        self.assertEqual(report['total']['statuses'], {'200': 1, '404': 1})
+        self.assertEqual(report['total']['exceptions'], {'ConnectionResetError': 1})
+        self.assertEqual(report['total']['p99_ms'], round(results[0].seconds * 1000, 2))
+        self.assertIsNone(report['routes']['unknown']['p50_ms'])
+
+        text = benchmark.format_report(report, baseline=report)
+        self.assertIn("error statuses: 404 x1", text)
+        self.assertIn("exceptions: ConnectionResetError x1", text)
+
+    def test_report_without_results(self):
+        """Does a run with no results format, without a TOTAL row?"""
+
+        report = benchmark.summarize([], 0.0, target='test')
+        text = benchmark.format_report(report, baseline=report)
+
+        self.assertIsNone(report['total'])
+        self.assertNotIn('TOTAL', text)
@@ -0,0 +1,154 @@
+"""Shared cache backend tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import socketserver
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import cache
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    """Just enough of a Redis server for RedisCache, backed by a MemoryCache."""
+
+    def handle(self):
+        store = self.server.store
+
+        while True:
+            command = cache.read_reply(self.rfile) if self.rfile.peek(1) else None
+
+            if not command:
+                return
+
+            self.server.commands.append(command)
+            name, *args = [arg.decode('utf-8') for arg in command]
+
+            if name == 'MGET':
+                found = store.get_many(args)
+                reply = [found.get(key) for key in args]
+            elif name == 'SET':
+                ttl = int(args[3]) / 1000 if len(args) > 2 else None
+                store.set(args[0], args[1], ttl)
+                reply = 'OK'
+            elif name == 'DEL':
+                store.delete(*args)
+                reply = len(args)
+            else:
+                reply = cache.CacheError(f"ERR unknown command '{name}'")
+
+            self.wfile.write(encode_reply(reply))
+
+    @classmethod
+    def serve(cls):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), cls)
+        server.daemon_threads = True
+        server.store = cache.MemoryCache()
+        server.commands = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+
+def encode_reply(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, cache.CacheError):
+        return b'-%s\r\n' % str(reply).encode('utf-8')
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, list):
+        return b'*%d\r\n' % len(reply) + b''.join(encode_reply(item) for item in reply)
+    if reply == 'OK':
+        return b'+OK\r\n'
+
+    return cache.encode_command([reply])[4:]
+
+
+class MemoryCacheTestCase(TestCase):
+    """Test the in-process backend."""
+
+    def test_get_and_set_many(self):
+        """Are values stored, expired after their TTL, and deleted?"""
+
+        store = cache.MemoryCache()
+        store.set_many({'a': '1', 'b': 2}, ttl=10)
+        store.set('c', 'three')
+
+        self.assertEqual(store.get_many(['a', 'b', 'c', 'd']), {'a': '1', 'b': '2', 'c': 'three'})
+
+        with patch('time.monotonic', return_value=time.monotonic() + 11):
+            self.assertEqual(store.get_many(['a', 'b', 'c']), {'c': 'three'})
+
+        store.delete('c')
+        self.assertIsNone(store.get('c'))
+        self.assertEqual(len(store), 0)
+
+    def test_eviction(self):
+        """Are the least recently used entries evicted past max_entries?"""
+
+        store = cache.MemoryCache(max_entries=2)
+        store.set_many({'a': 'a', 'b': 'b'})
+        store.get('a')
+        store.set('c', 'c')
+
+        self.assertEqual(store.get_many(['a', 'b', 'c']), {'a': 'a', 'c': 'c'})
+
+
+class RedisCacheTestCase(TestCase):
+    """Test the Redis protocol backend against a stand-in server."""
+
+    def setUp(self):
+        self.server = RESPHandler.serve()
+        self.store = cache.from_url(f"redis://127.0.0.1:{self.server.server_address[1]}")
+
+    def tearDown(self):
+        self.store._disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_round_trips(self):
+        """Do set_many and get_many each take one round trip, with TTLs?"""
+
+        self.store.set_many({f"k{i}": f"value {i} ✓" for i in range(100)}, ttl=1.5)
+        values = self.store.get_many([f"k{i}" for i in range(101)])
+
+        self.assertEqual(len(values), 100)
+        self.assertEqual(values['k7'], "value 7 ✓")
+        self.assertEqual(self.server.commands[0], [b'SET', b'k0', b'value 0 \xe2\x9c\x93',
+                                                   b'PX', b'1500'])
+        self.assertEqual([command[0] for command in self.server.commands].count(b'MGET'), 1)
+
+        self.store.delete('k7', 'k8')
+        self.assertEqual(self.store.get_many(['k7', 'k9']), {'k9': "value 9 ✓"})
+
+        with self.assertRaises(cache.CacheError):
+            self.store._execute([['NOPE'], ['DEL', 'k9']])
+
+        # the pipeline was read to the end, so the connection is still usable
+        self.assertIsNone(self.store.get('k9'))
+
+    def test_unavailable(self):
+        """Does a server that can't be reached act like an empty cache?"""
+
+        self.tearDown()
+
+        with self.assertLogs('warbler.cache', 'WARNING'):
+            self.assertEqual(self.store.get_many(['a']), {})
+            self.store.set('a', 'b')
+
+    def test_from_url(self):
+        store = cache.from_url("redis://:se%40cret@cache.internal:6380/2")
+
+        self.assertEqual(store.address, ('cache.internal', 6380))
+        self.assertEqual((store.db, store.password), (2, 'se@cret'))
+        self.assertEqual(cache.from_url("memory://?max_entries=5").max_entries, 5)
+        self.assertEqual(cache.from_url("null://").get_many(['a']), {})
+
+        with self.assertRaises(ValueError):
+            cache.from_url("memcached://localhost")
@@ -0,0 +1,73 @@
+"""Fan-out threshold benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fanout_benchmark.py
+
+
+import os
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Message, Follows, Likes, Timeline
+import fanout_benchmark
+
+db.create_all()
+
+
+class FanOutBenchmarkTestCase(TestCase):
+    """Test comparing fan-out thresholds."""
+
+    def setUp(self):
+        """One popular author with two followers, each of whom posted once."""
+
+        Timeline.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=name, email=f"{name}@test.com", password="HASHED",
+                      messages_count=1)
+                 for name in ['star', 'fan1', 'fan2']]
+
+        for user in users:
+            user.messages.append(Message(text=f"Hi from {user.username}"))
+
+        users[0].followers = users[1:]
+        users[0].followers_count = 2
+        db.session.add_all(users)
+        db.session.commit()
+
+        Timeline.rebuild()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_compare(self):
+        """Does each threshold report its write amplification and reads?"""
+
+        results = fanout_benchmark.compare([None, 1], posts=3, reads=3)
+
+        self.assertEqual([r['threshold'] for r in results], [None, 1])
+        self.assertEqual(results[0]['rows_per_post'], round(5 / 3, 2))
+        self.assertEqual(results[1]['rows_per_post'], 1)
+        self.assertEqual(results[0]['pulled_mean'], 0)
+        self.assertEqual(results[1]['pulled_mean'], round(2 / 3, 2))
+        self.assertIsNotNone(results[1]['read_p95_ms'])
+
+        # rolled back, and the setting restored
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Timeline.query.count(), 5)
+        self.assertIsNone(app.config['FAN_OUT_MAX_FOLLOWERS'])
+
+        self.assertIn('rows_per_post', fanout_benchmark.format_results(results))
+
+    def test_parse_thresholds(self):
+        self.assertEqual(fanout_benchmark.parse_thresholds("none,100"), [None, 100])
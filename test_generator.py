@@ -0,0 +1,95 @@
+"""Sample data generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import gzip
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generator'))
+
+import create_csvs
+
+
+class GeneratorTestCase(TestCase):
+    """Test generating the sample CSVs."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def generate(self, name, *args):
+        """Generate a small data set into a subfolder; return its path."""
+
+        out = os.path.join(self.folder, name)
+
+        create_csvs.generate(create_csvs.parse_args([
+            '--users', '200', '--messages', '150', '--follows', '2000',
+            '--chunk-size', '30', '--seed', '7', '--until', '2020-06-01',
+            '--out', out, *args]))
+
+        return out
+
+    def read(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+
+        with opener(path, 'rt', newline='') as f:
+            return f.read()
+
+    def test_output_independent_of_processes(self):
+        """Does a seed give the same files whatever the worker count?"""
+
+        one = self.generate('one', '--processes', '1')
+        three = self.generate('three', '--processes', '3')
+
+        for name in ['users.csv', 'messages.csv', 'follows.csv']:
+            self.assertEqual(self.read(os.path.join(one, name)),
+                             self.read(os.path.join(three, name)), name)
+
+        self.assertEqual(sorted(os.listdir(three)),
+                         ['follows.csv', 'messages.csv', 'users.csv'])
+
+    def test_follows(self):
+        """Are follows distinct, never of oneself, and skewed by popularity?"""
+
+        out = self.generate('follows', '--processes', '2')
+
+        with open(os.path.join(out, 'follows.csv'), newline='') as f:
+            rows = [(int(followed), int(follower))
+                    for followed, follower in list(csv.reader(f))[1:]]
+
+        self.assertEqual(len(rows), 2000)
+        self.assertEqual(len(set(rows)), len(rows))
+        self.assertFalse([row for row in rows if row[0] == row[1]])
+        self.assertTrue(all(1 <= user_id <= 200 for row in rows for user_id in row))
+
+        followers = Counter(followed for followed, follower in rows)
+        counts = [followers[user_id] for user_id in range(1, 201)]
+
+        self.assertGreater(max(counts), 10 * statistics.median(counts))
+
+    def test_gzip_parts_join_into_one_file(self):
+        """Do the gzipped parts join into a valid file with the plain contents?"""
+
+        plain = self.generate('plain', '--processes', '2')
+        zipped = self.generate('zipped', '--processes', '2', '--gzip')
+
+        for name in ['users.csv', 'messages.csv', 'follows.csv']:
+            path = os.path.join(zipped, name + '.gz')
+
+            with gzip.open(path, 'rt', newline='') as f:
+                rows = list(csv.reader(f))
+
+            self.assertEqual(rows[0], create_csvs.KINDS[name[:-4]][0])
+            self.assertEqual(self.read(path), self.read(os.path.join(plain, name)))
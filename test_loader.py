@@ -0,0 +1,144 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Message, Follows, Timeline
+import loader
+
+USERS_CSV = """email,username,image_url,password,bio,header_image_url,location
+a@test.com,alice,/static/images/default-pic.png,HASHED,,,Oakland
+b@test.com,bob,/static/images/default-pic.png,HASHED,"Likes, commas",,
+"""
+
+MESSAGES_CSV = """text,timestamp,user_id
+Hello,2017-01-21 11:04:53.522807,1
+Again,2017-01-22 11:04:53,2
+"""
+
+FOLLOWS_CSV = """user_being_followed_id,user_following_id
+2,1
+"""
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSV data."""
+
+    def setUp(self):
+        """Write a small data set, gzipping the messages, and enter the app."""
+
+        self.folder = tempfile.mkdtemp()
+        self.context = app.app_context()
+        self.context.push()
+
+        for name, data in [('users.csv', USERS_CSV), ('follows.csv', FOLLOWS_CSV)]:
+            with open(os.path.join(self.folder, name), 'w') as f:
+                f.write(data)
+
+        with gzip.open(os.path.join(self.folder, 'messages.csv.gz'), 'wt') as f:
+            f.write(MESSAGES_CSV)
+
+    def tearDown(self):
+        """Clean up, leaving an empty schema for the other tests."""
+
+        db.session.rollback()
+        shutil.rmtree(self.folder)
+
+        Timeline.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        self.context.pop()
+
+    def test_load(self):
+        """Are rows copied in, with indexes, constraints and derived data added after?"""
+
+        reports = []
+        counts = loader.load(self.folder, report=reports.append)
+
+        self.assertEqual(counts, {'users': 2, 'messages': 2, 'follows': 1, 'timelines': 3})
+        self.assertTrue(any('rows/s' in line for line in reports))
+
+        bob = User.query.filter_by(username='bob').one()
+        self.assertEqual(bob.bio, 'Likes, commas')
+        self.assertIsNone(bob.header_image_url)
+        self.assertEqual(bob.followers_count, 1)
+        self.assertEqual(bob.messages_count, 1)
+
+        indexes = db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'users'").fetchall()
+        self.assertIn(('ix_users_username_lower',), indexes)
+        self.assertEqual(len(inspect(db.engine).get_foreign_keys('follows')), 2)
+
+        built = {index['name'] for index in inspect(db.engine).get_indexes('timelines')}
+        self.assertEqual(built, {index.name for index in Timeline.__table__.indexes})
+        self.assertEqual(len(inspect(db.engine).get_foreign_keys('timelines')), 3)
+
+    def test_load_plain_and_gzip(self):
+        """Is a folder with both users.csv and users.csv.gz refused, keeping the data?"""
+
+        loader.load(self.folder, report=lambda line: None)
+
+        with gzip.open(os.path.join(self.folder, 'users.csv.gz'), 'wt') as f:
+            f.write(USERS_CSV)
+
+        with self.assertRaises(ValueError):
+            loader.load(self.folder, report=lambda line: None)
+
+        self.assertEqual(User.query.count(), 2)
+
+    def test_create_all_after_load(self):
+        """Does create_all() still make foreign keys once a load has added them?"""
+
+        loader.load(self.folder, report=lambda line: None)
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+        self.assertEqual(len(inspect(db.engine).get_foreign_keys('follows')), 2)
+        self.assertEqual(len(inspect(db.engine).get_foreign_keys('messages')), 1)
+
+    def test_load_unknown_column(self):
+        """Is a file with columns the table doesn't have refused?"""
+
+        with open(os.path.join(self.folder, 'follows.csv'), 'w') as f:
+            f.write("user_being_followed_id,nonsense\n2,1\n")
+
+        with self.assertRaises(ValueError):
+            loader.load(self.folder, report=lambda line: None)
+
+        db.create_all()
+
+    def test_sqlite_fallback(self):
+        """Do databases without COPY get batched inserts?"""
+
+        engine = create_engine('sqlite://')
+
+        with engine.begin() as conn:
+            for table in loader.LOADED_TABLES:
+                loader.create_bare(conn, table)
+
+            for table in loader.LOADED_TABLES:
+                loader.load_table(conn, table, loader.csv_path(self.folder, table))
+                loader.finish_table(conn, table)
+
+            rows = conn.execute("SELECT username, location FROM users ORDER BY id").fetchall()
+            self.assertEqual(rows, [('alice', 'Oakland'), ('bob', None)])
+            self.assertEqual(conn.execute("SELECT count(*) FROM messages").scalar(), 2)
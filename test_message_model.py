@@ -1,9 +1,10 @@
 """Message model tests."""
 
 import os
+import threading
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, Timeline
 
 
 # set an evironmental variable
@@ -63,4 +64,54 @@ class MessageModelTestCase(TestCase):
 
         self.assertEqual(f"<User #{u.id}: {u.username}, {u.email}>", str(user))
 
- 
\ No newline at end of file
+    def test_timeline_rebuild(self):
+        """Does rebuilding timelines cover authors and their followers?"""
+
+        u1 = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD")
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u1.id, user_following_id=u2.id))
+        db.session.add(Message(text="Rebuild me", user_id=u1.id))
+        db.session.commit()
+
+        self.assertEqual(Timeline.rebuild(), 2)
+        db.session.commit()
+
+        owners = {t.user_id for t in Timeline.query.all()}
+        self.assertEqual(owners, {u1.id, u2.id})
+
+    def test_like_toggle_race(self):
+        """Does a toggle that loses an insert race still report the like?"""
+
+        u = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.flush()
+        m = Message(text="Race me", user_id=u.id)
+        db.session.add(m)
+        db.session.commit()
+
+        user_id, message_id = u.id, m.id
+        results = []
+
+        def toggle():
+            with app.app_context():
+                results.append(Likes.toggle(user_id, message_id))
+                db.session.commit()
+
+        with db.engine.connect() as conn:
+            other = conn.begin()
+            conn.execute(Likes.__table__.insert(), user_id=user_id, message_id=message_id)
+
+            # blocks on the uncommitted row until the other transaction commits
+            thread = threading.Thread(target=toggle)
+            thread.start()
+            thread.join(0.5)
+            other.commit()
+            thread.join()
+
+        self.assertEqual(results, [(True, 1)])
+        self.assertEqual(Likes.toggle(user_id, message_id), (False, 0))
+        db.session.commit()
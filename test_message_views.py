@@ -6,9 +6,13 @@
 
 
 import os
+import re
+import sys
+import time
 from unittest import TestCase
+from unittest.mock import Mock, patch
 
-from models import db, connect_db, Message, User, Likes
+from models import db, connect_db, Message, User, Likes, Timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +23,12 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, home_feeds, message_fragments, profile_cards
+import cache
+from fragments import FragmentCache
+from pagination import keyset_query
+from profile_cards import ProfileCardCache
+import query_stats
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +50,8 @@ class MessageViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
         Likes.query.delete()
+        message_fragments.clear()
+        profile_cards.clear()
 
         self.client = app.test_client()
 
@@ -105,6 +116,10 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("""<p class="single-message">Hello</p>""", html)
 
+            # viewing it again with the same ETag needs no new page
+            resp = c.get(f"/messages/{m_id}", headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
         # logout user, then try to view a message, which can be done
         with self.client as c:
                 with c.session_transaction() as sess:
@@ -118,6 +133,27 @@ class MessageViewTestCase(TestCase):
                 self.assertIn("""<p class="single-message">Hello</p>""", html)
 
 
+    def test_view_followed_message(self):
+        """Is the follow state looked up once, for both the ETag and the page?"""
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="password", image_url=None)
+        other.messages.append(Message(text="Followed"))
+        db.session.commit()
+        other_id, m_id = other.id, other.messages[0].id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{other_id}")
+
+            # the message with its author, and the follow
+            resp = c.get(f"/messages/{m_id}")
+
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+            self.assertEqual(query_stats.queries(resp.headers), 2)
+
     def test_delete_message(self):
         """Test that a message can be deleted."""
 
@@ -213,8 +249,26 @@ class MessageViewTestCase(TestCase):
             resp = c.post(f"/users/add_like/{m_id}", follow_redirects=True)
             data = resp.json
 
-            self.assertEqual({"message" : f"Message number {m_id} liked"}, data)
+            self.assertEqual({"message" : f"Message number {m_id} liked",
+                              "liked" : True,
+                              "likes" : 1}, data)
             self.assertEqual(resp.status_code, 200)
+
+        # a second user's like is counted separately
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/users/add_like/{m_id}")
+            self.assertEqual(resp.json["likes"], 2)
+
+            resp = c.post(f"/users/add_like/{m_id}")
+            self.assertEqual(resp.json["likes"], 1)
+            self.assertFalse(resp.json["liked"])
+
+            # liking a message that doesn't exist
+            resp = c.post("/users/add_like/0")
+            self.assertEqual(resp.status_code, 404)
             
         # logout user, then try to like a message
         with self.client as c:
@@ -226,4 +280,527 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("""<h2 class="join-message">Welcome back.</h2>""", html)
 
-        
\ No newline at end of file
+
+    def test_timeline_fan_out(self):
+        """Test that a new message reaches followers and leaves on delete."""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="testuser",
+                               image_url=None)
+        follower.following.append(self.testuser)
+        db.session.commit()
+
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello followers"})
+            m_id = Message.query.one().id
+
+            # the author and the follower both get a timeline entry
+            owners = {t.user_id for t in Timeline.query.filter_by(message_id=m_id)}
+            self.assertEqual(owners, {self.testuser.id, follower_id})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>Hello followers</p>", html)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/messages/{m_id}/delete")
+
+            self.assertEqual(Timeline.query.all(), [])
+
+
+    def test_feed_pagination(self):
+        """Test that the home feed pages through older messages with a cursor."""
+
+        for i in range(5):
+            db.session.add(Message(text=f"Message {i}",
+                                   timestamp=f"2020-01-0{i + 1} 00:00:00",
+                                   user_id=self.testuser.id))
+        Timeline.rebuild()
+        db.session.commit()
+
+        with patch('app.MESSAGES_PER_PAGE', 2), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("<p>Message 4</p>", html)
+            self.assertIn("<p>Message 3</p>", html)
+            self.assertNotIn("<p>Message 2</p>", html)
+            self.assertIn('data-next-page="/feed?before=', html)
+
+            seen = []
+            next_page = html.split('data-next-page="')[1].split('"')[0]
+
+            while next_page:
+                resp = c.get(next_page)
+                self.assertEqual(resp.status_code, 200)
+                seen.append(resp.get_data(as_text=True))
+                next_page = resp.headers.get('X-Next-Page')
+
+            html = "".join(seen)
+
+            self.assertEqual(len(seen), 2)
+            self.assertNotIn("<p>Message 3</p>", html)
+            self.assertIn("<p>Message 2</p>", html)
+            self.assertIn("<p>Message 0</p>", html)
+
+            resp = c.get("/feed?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_likes_summary(self):
+        """Test batch like state and like counts for a set of messages."""
+
+        testuser_id = self.testuser.id
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="testuser", image_url=None)
+        db.session.flush()
+
+        liked = Message(text="Liked", user_id=other.id)
+        unliked = Message(text="Not liked", user_id=other.id)
+        db.session.add_all([liked, unliked])
+        db.session.flush()
+
+        db.session.add(Likes(user_id=testuser_id, message_id=liked.id))
+        db.session.add(Likes(user_id=other.id, message_id=liked.id))
+        db.session.commit()
+
+        liked_id, unliked_id = liked.id, unliked.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/api/likes?ids={liked_id},{unliked_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"likes": {
+                str(liked_id): {"liked": True, "count": 2},
+                str(unliked_id): {"liked": False, "count": 0},
+            }})
+
+            resp = c.get("/api/likes?ids=1,two")
+            self.assertEqual(resp.status_code, 400)
+
+        # logged out readers still get counts
+        with self.client as c:
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+            resp = c.get(f"/api/likes?ids={liked_id}")
+            self.assertEqual(resp.json["likes"][str(liked_id)], {"liked": False, "count": 2})
+
+    def test_like_states_for_long_likes_page(self):
+        """Test that a likes page of more than MAX_LIKE_IDS loads in batches."""
+
+        testuser_id = self.testuser.id
+        messages = [Message(text=f"Liked {i}", user_id=testuser_id) for i in range(205)]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        db.session.add_all([Likes(user_id=testuser_id, message_id=msg.id)
+                            for msg in messages])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            html = c.get(f"/users/{testuser_id}/likes").get_data(as_text=True)
+            ids = re.findall(r"data-message-id='(\d+)'", html)
+            batch_size = int(re.search(r'data-max-like-ids="(\d+)"', html).group(1))
+
+            self.assertEqual(len(ids), 205)
+            self.assertEqual(c.get("/api/likes", query_string={"ids": ",".join(ids)})
+                             .status_code, 400)
+
+            # as app.js's loadLikeStates does
+            likes = {}
+
+            for start in range(0, len(ids), batch_size):
+                resp = c.get("/api/likes",
+                             query_string={"ids": ",".join(ids[start:start + batch_size])})
+                self.assertEqual(resp.status_code, 200)
+                likes.update(resp.json["likes"])
+
+            self.assertEqual(set(likes), set(ids))
+            self.assertTrue(all(state == {"liked": True, "count": 1}
+                                for state in likes.values()))
+
+
+    def test_message_fragment_cache(self):
+        """Test that message markup is cached and invalidated on delete and profile edit."""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Cache me"})
+            m_id = Message.query.one().id
+
+            c.get(f"/users/{testuser_id}")
+            c.get("/")
+
+            # rendered once, reused for the second page
+            self.assertEqual(len(message_fragments), 1)
+            self.assertEqual(message_fragments.hits, 1)
+
+            data = {
+                "username": "testuser",
+                "email": "test@test.com",
+                "image_url": "/static/images/smile.png",
+                "password": "testuser",
+                }
+            c.post("/users/profile", data=data)
+
+            self.assertEqual(len(message_fragments), 0)
+
+            resp = c.get("/")
+            self.assertIn('<img src="/static/images/smile.png" alt="" class="timeline-image">',
+                          resp.get_data(as_text=True))
+
+            c.post(f"/messages/{m_id}/delete")
+
+            self.assertEqual(len(message_fragments), 0)
+
+    def test_fragment_cache_memory_cap(self):
+        """Test that the fragment cache evicts least recently used entries past its cap."""
+
+        cache = FragmentCache(max_bytes=3 * sys.getsizeof("x" * 100))
+
+        for i in range(3):
+            cache.get_or_render(i, i, 1, lambda: "x" * 100)
+
+        # touch 0 so 1 is the least recently used
+        cache.get_or_render(0, 0, 1, lambda: "unused")
+        cache.get_or_render(3, 3, 1, lambda: "x" * 100)
+
+        self.assertEqual(len(cache), 3)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        self.assertEqual(cache.get_or_render(1, 1, 1, lambda: "rendered again"), "rendered again")
+
+        cache.invalidate_author(1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+    def test_shared_fragment_cache(self):
+        """Test that fragments rendered by one process are reused by another."""
+
+        testuser_id = self.testuser.id
+        shared_cache = cache.MemoryCache()
+
+        with patch('app.shared_cache', shared_cache), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Share me"})
+            m_id = Message.query.one().id
+
+            c.get("/")
+
+            key = f"fragment:{m_id}:1"
+            self.assertIn("<p>Share me</p>", shared_cache.get(key))
+
+            # as if in a fresh worker: nothing local, only the shared cache
+            message_fragments.clear()
+            shared_cache.set(key, shared_cache.get(key).replace("Share me", "Shared"))
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("<p>Shared</p>", html)
+            self.assertEqual(message_fragments.misses, 1)
+
+            html = c.get(f"/users/{testuser_id}").get_data(as_text=True)
+            self.assertIn("<p>Shared</p>", html)
+            self.assertEqual(message_fragments.hits, 1)
+
+    def test_shared_fragment_cache_errors(self):
+        """Test that error replies from the shared cache don't break pages."""
+
+        testuser_id = self.testuser.id
+        shared_cache = Mock(spec=cache.Cache)
+        shared_cache.get_many.side_effect = cache.CacheError("OOM command not allowed")
+        shared_cache.set_many.side_effect = cache.CacheError("OOM command not allowed")
+
+        with patch('app.shared_cache', shared_cache), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Still here"})
+
+            with self.assertLogs('warbler.cache', 'WARNING') as logs:
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>Still here</p>", resp.get_data(as_text=True))
+            self.assertEqual(len(logs.output), 2)
+
+
+    def test_profile_card_cache(self):
+        """Test that authors come from profile cards, refreshed on profile edit."""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Card me"})
+            c.get("/")
+            c.get("/")
+
+            stats = profile_cards.stats()
+            self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (1, 1, 1))
+            self.assertEqual(stats['hit_rate'], 0.5)
+            self.assertGreater(stats['bytes'], 0)
+
+            data = {
+                "username": "carded",
+                "email": "test@test.com",
+                "password": "testuser",
+                }
+            c.post("/users/profile", data=data)
+
+            self.assertEqual(len(profile_cards), 0)
+            self.assertIn("@carded", c.get("/").get_data(as_text=True))
+
+            self.assertIn('warbler_profile_card_cache{stat="entries"} 1',
+                          c.get("/metrics").get_data(as_text=True))
+
+            resp = c.get(f"/users/{testuser_id}/messages")
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.get("/users/0/messages")
+            self.assertEqual(resp.status_code, 404)
+
+
+    def test_profile_card_expiry_and_cap(self):
+        """Test that profile cards expire after their TTL and are capped in number."""
+
+        users = [User.signup(username=f"card{i}", email=f"card{i}@test.com",
+                             password="testuser", image_url=None)
+                 for i in range(3)]
+        db.session.commit()
+        ids = [user.id for user in users]
+
+        cache = ProfileCardCache(max_entries=2, ttl=60)
+
+        self.assertEqual(cache.get_many(ids[:2]).keys(), set(ids[:2]))
+        self.assertEqual(cache.get(ids[0]).username, "card0")
+        self.assertIsNone(cache.get(0))
+
+        # 1 is the least recently used
+        cache.get(ids[2])
+        self.assertEqual(set(cache._cards), {ids[0], ids[2]})
+
+        with patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(cache.get(ids[0]).id, ids[0])
+
+        self.assertEqual(cache.misses, 5)
+        self.assertFalse(hasattr(cache.get(ids[0]), '__dict__'))
+
+
+    def test_api_feed(self):
+        """Test the JSON feed endpoints and their cursor paging."""
+
+        testuser_id = self.testuser.id
+
+        for i in range(3):
+            db.session.add(Message(text=f"Message {i}",
+                                   timestamp=f"2020-01-0{i + 1} 00:00:00",
+                                   user_id=testuser_id))
+        Timeline.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/api/feed")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            for url in ["/api/feed", f"/api/users/{testuser_id}/messages"]:
+                resp = c.get(f"{url}?limit=2")
+                data = resp.json
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual([m["text"] for m in data["messages"]], ["Message 2", "Message 1"])
+                self.assertEqual(data["messages"][0]["user"]["username"], "testuser")
+                self.assertEqual(data["messages"][0]["timestamp"], "2020-01-03T00:00:00")
+
+                resp = c.get(url, query_string={"limit": 2, "before": data["next"]})
+                data = resp.json
+
+                self.assertEqual([m["text"] for m in data["messages"]], ["Message 0"])
+                self.assertIsNone(data["next"])
+
+            resp = c.get("/api/feed?limit=zero")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.get("/api/users/0/messages")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_hybrid_feed(self):
+        """Test that authors over the fan-out threshold are merged in at read time."""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="testuser",
+                               image_url=None)
+        follower.following.append(self.testuser)
+        self.testuser.followers_count = 1
+        db.session.commit()
+
+        follower_id = follower.id
+        testuser_id = self.testuser.id
+
+        for i, user_id in enumerate([testuser_id, follower_id, testuser_id]):
+            db.session.add(Message(text=f"Message {i}",
+                                   timestamp=f"2020-01-0{i + 1} 00:00:00",
+                                   user_id=user_id))
+
+        # fanned out before the threshold was set: mustn't show up twice
+        Timeline.rebuild()
+        db.session.commit()
+
+        with patch.dict(app.config, FAN_OUT_MAX_FOLLOWERS=0), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Message 3"})
+            m_id = Message.query.filter_by(text="Message 3").one().id
+
+            # only the author's own timeline is written
+            owners = {t.user_id for t in Timeline.query.filter_by(message_id=m_id)}
+            self.assertEqual(owners, {testuser_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            data = c.get("/api/feed?limit=3").json
+            self.assertEqual([m["text"] for m in data["messages"]],
+                             ["Message 3", "Message 2", "Message 1"])
+
+            data = c.get("/api/feed", query_string={"before": data["next"]}).json
+            self.assertEqual([m["text"] for m in data["messages"]], ["Message 0"])
+
+            with patch('app.MESSAGES_PER_PAGE', 2):
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("<p>Message 3</p>", html)
+                self.assertIn("<p>Message 2</p>", html)
+                self.assertNotIn("<p>Message 1</p>", html)
+
+                next_page = html.split('data-next-page="')[1].split('"')[0]
+                html = c.get(next_page).get_data(as_text=True)
+                self.assertEqual(html.count("<p>Message "), 2)
+                self.assertIn("<p>Message 1</p>", html)
+                self.assertIn("<p>Message 0</p>", html)
+
+        self.assertFalse(Message.query.get(m_id).fanned_out)
+
+        # back under the threshold, or with none: still there, just pulled
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            data = c.get("/api/feed").json
+            self.assertEqual([m["text"] for m in data["messages"]],
+                             ["Message 3", "Message 2", "Message 1", "Message 0"])
+
+        # a new follower gets the pushed messages copied and pulls the rest
+        latecomer = User.signup(username="latecomer",
+                                email="latecomer@test.com",
+                                password="testuser",
+                                image_url=None)
+        db.session.commit()
+        latecomer_id = latecomer.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = latecomer_id
+
+            c.post(f"/users/follow/{testuser_id}")
+
+            data = c.get("/api/feed").json
+            self.assertEqual([m["text"] for m in data["messages"]],
+                             ["Message 3", "Message 2", "Message 0"])
+
+        self.assertEqual(Timeline.query.filter_by(user_id=latecomer_id).count(), 2)
+
+        # each pulled author is read for at most a page, however much they posted
+        for i in range(5):
+            db.session.add(Message(text=f"Pulled {i}", user_id=testuser_id,
+                                   timestamp=f"2019-01-0{i + 1} 00:00:00",
+                                   fanned_out=False))
+        db.session.commit()
+
+        feeds = home_feeds(latecomer_id, Message.query)
+        self.assertEqual(len(feeds), 2)
+
+        for query, timestamp_col, id_col in feeds:
+            statement = keyset_query(query, timestamp_col, id_col).limit(2).statement
+            sql = str(statement.compile(dialect=db.engine.dialect,
+                                        compile_kwargs={'literal_binds': True}))
+            nodes = [db.session.execute(
+                f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}").scalar()[0]['Plan']]
+
+            while nodes:
+                node = nodes.pop()
+                self.assertLessEqual(node['Actual Rows'], 2, node['Node Type'])
+                nodes.extend(node.get('Plans', []))
+
+    def test_message_query_budgets(self):
+        """Test the number of queries message routes run, and that they're reported."""
+
+        c = self.client
+
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        with self.assertLogs('warbler.requests', 'INFO') as logs:
+            resp = c.post("/messages/new", data={"text": "Budget"})
+
+        self.assertRegex(resp.headers['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+        self.assertIn('"endpoint": "messages_add"', logs.output[0])
+        self.assertIn('"status": 302', logs.output[0])
+
+        m_id = Message.query.one().id
+
+        budgets = [
+            ("POST", "/messages/new", 6),
+            ("GET", f"/messages/{m_id}", 2),
+            ("POST", f"/users/add_like/{m_id}", 1),
+            ("GET", f"/api/likes?ids={m_id}", 1),
+            # timeline and pulled messages; authors' profile cards are
+            # loaded once, then cached
+            ("GET", "/feed", 3),
+            ("GET", "/feed", 2),
+            ("POST", f"/messages/{m_id}/delete", 5),
+        ]
+
+        for method, url, budget in budgets:
+            resp = c.open(url, method=method, data={"text": "Budget"})
+
+            self.assertLess(resp.status_code, 400, url)
+            self.assertEqual(query_stats.queries(resp.headers), budget, url)
@@ -0,0 +1,143 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from models import db, User
+import metrics
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Test the metrics registry and the /metrics endpoint."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_exposition(self):
+        """Are counters, gauges and histograms written in the text format?"""
+
+        registry = metrics.Registry()
+        hits = registry.counter('hits_total', "Hits.", ['page'])
+        registry.gauge('depth', "Depth.", function=lambda: 3)
+        latency = registry.histogram('latency_seconds', "Latency.", buckets=(.1, 1))
+
+        hits.inc(page='a "quoted" page')
+        hits.inc(2, page='a "quoted" page')
+        latency.observe(.1)
+        latency.observe(5)
+
+        text = metrics.collect(registry)
+
+        self.assertIn('# TYPE hits_total counter\n', text)
+        self.assertIn('hits_total{page="a \\"quoted\\" page"} 3\n', text)
+        self.assertIn('depth 3\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('latency_seconds_sum 5.1\n', text)
+        self.assertIn('latency_seconds_count 2\n', text)
+
+        with self.assertRaises(ValueError):
+            hits.inc(pages='wrong label')
+
+    def test_merged_across_processes(self):
+        """Are other workers' counters added in, and exited workers' gauges dropped?"""
+
+        registry = metrics.Registry()
+        hits = registry.counter('hits_total', "Hits.")
+        registry.gauge('depth', "Depth.", function=lambda: 1)
+        hits.inc()
+
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+
+        with open(os.path.join(self.directory, f"{exited.pid}.json"), 'w') as f:
+            json.dump({'hits_total': [[[], 10]], 'depth': [[[], 5]]}, f)
+
+        text = metrics.collect(registry, metrics.SnapshotStore(self.directory))
+
+        self.assertIn('hits_total 11\n', text)
+        self.assertIn('depth 1\n', text)
+
+    def test_metrics_endpoint(self):
+        """Are requests and pool checkouts counted by endpoint?"""
+
+        user = User(username="metrics", email="metrics@test.com", password="HASHED")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get(f'/users/{user_id}')
+            resp = c.get('/metrics')
+
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertRegex(text, r'warbler_requests_total\{endpoint="users_show",'
+                               r'method="GET",status="200"\} \d+')
+        self.assertIn('warbler_request_duration_seconds_count{endpoint="users_show"}', text)
+        self.assertIn('warbler_db_pool_checkout_wait_seconds_count{engine="primary"}', text)
+        self.assertIn('warbler_bcrypt_queue_depth 0', text)
+
+        db.session.delete(User.query.get(user_id))
+        db.session.commit()
+
+    def test_streamed_request_recorded_at_close(self):
+        """Is a streamed response counted once its body has been sent?"""
+
+        def following_count(text):
+            match = re.search(r'warbler_requests_total\{endpoint="show_following",'
+                              r'method="GET",status="200"\} (\d+)', text)
+            return int(match.group(1)) if match else 0
+
+        user = User(username="metrics", email="metrics@test.com", password="HASHED")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            before = following_count(c.get('/metrics').get_data(as_text=True))
+
+            resp = c.get(f'/users/{user_id}/following', buffered=False)
+            self.assertTrue(resp.is_streamed)
+            self.assertNotIn('Server-Timing', resp.headers)
+            self.assertEqual(
+                following_count(c.get('/metrics').get_data(as_text=True)), before)
+
+            resp.get_data()
+            resp.close()
+            self.assertEqual(
+                following_count(c.get('/metrics').get_data(as_text=True)), before + 1)
+
+        db.session.delete(User.query.get(user_id))
+        db.session.commit()
@@ -0,0 +1,213 @@
+"""Migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Message, Likes, Follows, Timeline
+import migrations
+
+db.create_all()
+
+# the schema as it was before any migrations
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id SERIAL PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    image_url TEXT,
+    header_image_url TEXT,
+    bio TEXT,
+    location TEXT,
+    password TEXT NOT NULL
+);
+
+CREATE TABLE follows (
+    user_being_followed_id INTEGER REFERENCES users ON DELETE cascade,
+    user_following_id INTEGER REFERENCES users ON DELETE cascade,
+    PRIMARY KEY (user_being_followed_id, user_following_id)
+);
+
+CREATE TABLE messages (
+    id SERIAL PRIMARY KEY,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE
+);
+
+CREATE TABLE likes (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users ON DELETE cascade,
+    message_id INTEGER UNIQUE REFERENCES messages ON DELETE cascade
+);
+"""
+
+SCHEMA_QUERIES = [
+    """SELECT table_name, column_name, data_type, character_maximum_length,
+              is_nullable, column_default
+       FROM information_schema.columns WHERE table_schema = 'public'""",
+    """SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+       FROM pg_constraint WHERE connamespace = 'public'::regnamespace""",
+    "SELECT tablename, indexdef FROM pg_indexes WHERE schemaname = 'public'",
+]
+
+
+def index_names(table):
+    return {name for name, in db.session.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :table", {'table': table})}
+
+
+def schema(engine):
+    """The columns, constraints and indexes of every table but schema_migrations."""
+
+    with engine.connect() as conn:
+        return [sorted(row for row in map(tuple, conn.execute(query))
+                       if 'schema_migrations' not in row[0])
+                for query in SCHEMA_QUERIES]
+
+
+class MigrationsTestCase(TestCase):
+    """Test applying migrations."""
+
+    def setUp(self):
+        with db.engine.connect() as conn:
+            migrations.schema_migrations.drop(conn, checkfirst=True)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_migrate(self):
+        """Are missing indexes built, and each migration applied only once?"""
+
+        index = migrations.MIGRATIONS[0].indexes[0]
+
+        with db.engine.connect() as conn:
+            migrations.drop_index_online(
+                conn.execution_options(isolation_level='AUTOCOMMIT'), index)
+
+        self.assertNotIn(index.name, index_names(index.table.name))
+
+        reports = []
+        applied = migrations.migrate(db.engine, report=reports.append)
+        db.session.commit()
+
+        self.assertEqual(applied, [migration.id for migration in migrations.MIGRATIONS])
+        self.assertIn(index.name, index_names(index.table.name))
+        self.assertIn('ix_follows_user_following_id', index_names('follows'))
+        self.assertEqual(migrations.migrate(db.engine, report=reports.append), [])
+
+    def test_upgrade_old_schema(self):
+        """Are an old database's likes rekeyed and new columns added and filled?"""
+
+        Timeline.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User(username="old", email="old@test.com", password="HASHED")
+        user.messages.append(Message(text="From before the counters"))
+        db.session.add(user)
+        db.session.commit()
+
+        user_id, message_id = user.id, user.messages[0].id
+        db.session.close()
+
+        with db.engine.begin() as conn:
+            conn.execute("ALTER TABLE users DROP COLUMN messages_count, "
+                         "DROP COLUMN following_count, DROP COLUMN followers_count, "
+                         "DROP COLUMN likes_count, DROP COLUMN profile_version")
+            conn.execute("ALTER TABLE messages DROP COLUMN fanned_out")
+            conn.execute("DROP TABLE likes")
+            conn.execute("CREATE TABLE likes (id SERIAL PRIMARY KEY, "
+                         "user_id INTEGER REFERENCES users ON DELETE CASCADE, "
+                         "message_id INTEGER UNIQUE REFERENCES messages ON DELETE CASCADE)")
+            conn.execute(text("INSERT INTO likes (user_id, message_id) VALUES (:u, :m)"),
+                         u=user_id, m=message_id)
+
+        migrations.migrate(db.engine, report=lambda line: None)
+
+        user = User.query.get(user_id)
+        self.assertEqual((user.messages_count, user.likes_count, user.profile_version),
+                         (1, 1, 1))
+        self.assertTrue(Message.query.get(message_id).fanned_out)
+        self.assertIn('ix_messages_user_id_timestamp_pulled', index_names('messages'))
+
+        keys = inspect(db.engine).get_pk_constraint('likes')['constrained_columns']
+        self.assertEqual(sorted(keys), ['message_id', 'user_id'])
+        self.assertIn('ix_likes_message_id', index_names('likes'))
+        self.assertEqual(Likes.toggle(user_id, message_id), (False, 0))
+
+        db.session.rollback()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_migrate_baseline(self):
+        """Do the migrations bring the original schema up to what create_all makes?"""
+
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        url.database = 'warbler-migrate-test'
+
+        server_url = make_url(str(url))
+        server_url.database = 'postgres'
+        server = create_engine(server_url, isolation_level='AUTOCOMMIT',
+                               poolclass=NullPool)
+
+        server.execute(f'DROP DATABASE IF EXISTS "{url.database}"')
+        server.execute(f'CREATE DATABASE "{url.database}"')
+        engine = create_engine(url, poolclass=NullPool)
+
+        try:
+            with engine.begin() as conn:
+                conn.execute(BASELINE_SCHEMA)
+
+            migrations.migrate(engine, report=lambda line: None)
+            self.assertEqual(schema(engine), schema(db.engine))
+        finally:
+            engine.dispose()
+            server.execute(f'DROP DATABASE "{url.database}"')
+
+    def test_explain_indexes(self):
+        """Do the "before" plans run without the feed and graph indexes?"""
+
+        # the tables are tiny: make the planner use any index it can
+        engine = create_engine(db.engine.url,
+                               connect_args={'options': '-c enable_seqscan=off'})
+
+        try:
+            results = migrations.explain_indexes(engine, user_id=1, runs=1)
+        finally:
+            engine.dispose()
+
+        def indexes_used(query, phase):
+            return {node.split()[-1] for node in results[query][phase]['plan']}
+
+        self.assertNotIn('ix_messages_user_id_timestamp',
+                         indexes_used('messages by user', 'before'))
+        self.assertNotIn('ix_follows_user_following_id',
+                         indexes_used('users followed by user', 'before'))
+        self.assertIn('ix_messages_user_id_timestamp', index_names('messages'))
+
+    def test_explain_queries(self):
+        """Do the benchmark queries compile to SQL that Postgres can plan?"""
+
+        with db.engine.connect() as conn:
+            for statement in migrations.explain_queries(user_id=1).values():
+                summary = migrations.plan_summary(conn, statement, runs=1)
+                self.assertTrue(summary['plan'])
@@ -0,0 +1,127 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_routing.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, message_fragments, profile_cards
+from models import db, User, Message, Follows, Likes, Timeline
+import current_user
+import routing
+
+REPLICA_DB = 'warbler-test-replica'
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def create_replica_database():
+    """Make an empty second database to stand in for a replica."""
+
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        if not conn.execute("SELECT 1 FROM pg_database WHERE datname = %s",
+                            REPLICA_DB).scalar():
+            conn.execute(f'CREATE DATABASE "{REPLICA_DB}"')
+
+
+class RoutingTestCase(TestCase):
+    """Test sending reads to a replica."""
+
+    def setUp(self):
+        """Put the same user in both databases, and a message only on the replica."""
+
+        create_replica_database()
+        routing.set_replicas(app, [f"postgresql:///{REPLICA_DB}"])
+        self.replica = app.extensions['read_replicas'][0]
+
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+
+        Timeline.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        current_user.clear()
+        message_fragments.clear()
+        profile_cards.clear()
+
+        user = dict(id=5000, username="reader", email="reader@test.com",
+                    password="HASHED", image_url="/static/images/default-pic.png",
+                    header_image_url="/static/images/warbler-hero.jpg",
+                    messages_count=0)
+
+        db.session.execute(User.__table__.insert(), user)
+        db.session.commit()
+
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), dict(user, messages_count=1))
+            conn.execute(Message.__table__.insert(),
+                         dict(id=9000, text="Only on the replica", user_id=5000,
+                              timestamp=datetime.utcnow()))
+
+    def tearDown(self):
+        db.session.rollback()
+        routing.set_replicas(app, [])
+
+    def test_reads_go_to_replica_until_a_write(self):
+        """Do GETs read the replica, except just after the client writes?"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5000
+
+            html = c.get('/users/5000').get_data(as_text=True)
+            self.assertIn("Only on the replica", html)
+
+            resp = c.post('/messages/new', data={"text": "Just posted"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Message.query.filter_by(text="Just posted").count(), 1)
+
+            # pinned to the primary: our own write shows up
+            html = c.get('/users/5000').get_data(as_text=True)
+            self.assertIn("Just posted", html)
+            self.assertNotIn("Only on the replica", html)
+
+            with c.session_transaction() as sess:
+                sess[routing.PIN_KEY] = 0
+
+            html = c.get('/users/5000').get_data(as_text=True)
+            self.assertIn("Only on the replica", html)
+
+            metrics_text = c.get('/metrics').get_data(as_text=True)
+            self.assertIn('warbler_db_pool_checkout_wait_seconds_count{engine="replica0"}',
+                          metrics_text)
+            self.assertIn('warbler_db_pool_checked_out{engine="replica0"}', metrics_text)
+
+    def test_no_replicas(self):
+        """Without replicas, is everything read from the primary, unpinned?"""
+
+        routing.set_replicas(app, [])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5000
+
+            self.assertNotIn("Only on the replica",
+                             c.get('/users/5000').get_data(as_text=True))
+
+            c.post('/messages/new', data={"text": "Just posted"})
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(routing.PIN_KEY, sess)
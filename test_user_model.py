@@ -6,9 +6,16 @@
 
 
 import os
+import signal
+from concurrent.futures.process import BrokenProcessPool
 from unittest import TestCase
 
+from unittest.mock import patch
+
+import bcrypt
+
 from models import db, User, Message, Follows
+import passwords
 from sqlalchemy.exc import IntegrityError
 
 
@@ -151,6 +158,23 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(res)
 
+    def test_following_ids(self):
+
+        users = [User(email=f"testuser{i}@test.com", username=f"testuser{i}", password="HASHED_PASSWORD")
+                 for i in range(3)]
+
+        db.session.add_all(users)
+        db.session.commit()
+
+        user0, user1, user2 = users
+
+        db.session.add(Follows(user_being_followed_id=user1.id, user_following_id=user0.id))
+        db.session.commit()
+
+        # one lookup for the whole page of users
+        self.assertEqual(user0.following_ids([user1.id, user2.id]), {user1.id})
+        self.assertEqual(user0.following_ids([]), set())
+
     def test_signup(self):
 
         user = User.signup(
@@ -211,6 +235,102 @@ class UserModelTestCase(TestCase):
        
         self.assertFalse(User.authenticate("JohnnyTest", "THE_WRONG_TEST_PASSWORD"))
 
+    def test_reconcile_counts(self):
+
+        user1 = User(email="testuser1@test.com", username="testuser1", password="HASHED_PASSWORD")
+        user2 = User(email="testuser2@test.com", username="testuser2", password="HASHED_PASSWORD")
+
+        db.session.add_all([user1, user2])
+        db.session.commit()
+
+        # write rows directly, bypassing the routes that keep counts in step
+        db.session.add(Follows(user_being_followed_id=user1.id, user_following_id=user2.id))
+        db.session.add(Message(text="Count me", user_id=user1.id))
+        db.session.commit()
+
+        self.assertEqual(user1.messages_count, 0)
+
+        # both users are out of step
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+
+        self.assertEqual(user1.messages_count, 1)
+        self.assertEqual(user1.followers_count, 1)
+        self.assertEqual(user2.following_count, 1)
+
+        # nothing left to fix
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_authenticate_rehashes_changed_cost(self):
+
+        old_hash = bcrypt.hashpw(b"TEST_PASSWORD", bcrypt.gensalt(4)).decode('utf-8')
+
+        user = User(email="johnny@test.com", username="JohnnyTest", password=old_hash)
+        db.session.add(user)
+        db.session.commit()
+
+        self.assertTrue(passwords.needs_rehash(old_hash))
+
+        auth_user = User.authenticate("JohnnyTest", "TEST_PASSWORD")
+        db.session.commit()
+
+        self.assertNotEqual(auth_user.password, old_hash)
+        self.assertFalse(passwords.needs_rehash(auth_user.password))
+        self.assertTrue(passwords.check_password(auth_user.password, "TEST_PASSWORD"))
+
+    def test_authenticate_recent_window(self):
+
+        User.signup(username="JohnnyTest", password="TEST_PASSWORD",
+                    email="johnny@test.com", image_url=None)
+        db.session.commit()
+
+        User.authenticate("JohnnyTest", "TEST_PASSWORD")
+
+        with patch('passwords.check_password') as check_password:
+            self.assertTrue(User.authenticate("JohnnyTest", "TEST_PASSWORD", recent_ok=True))
+            check_password.assert_not_called()
+
+            # a wrong password still goes through bcrypt
+            check_password.return_value = False
+            self.assertFalse(User.authenticate("JohnnyTest", "WRONG_PASSWORD", recent_ok=True))
+            check_password.assert_called_once()
+
+    def test_password_pool_queue_limit(self):
+
+        with app.test_request_context(), \
+                patch.dict(passwords.settings, {'BCRYPT_MAX_QUEUE': 0}):
+            with self.assertRaises(passwords.PasswordHasherBusy):
+                passwords.hash_password("TEST_PASSWORD")
+
+    def test_password_pool_outside_requests(self):
+        """Outside a request, is bcrypt run in the caller, without a pool?"""
+
+        with patch('passwords._pool') as pool:
+            self.assertTrue(passwords.check_password(
+                passwords.hash_password("TEST_PASSWORD"), "TEST_PASSWORD"))
+
+        pool.assert_not_called()
+
+    def test_password_pool_worker_killed(self):
+        """Is a pool with a dead worker replaced instead of failing for good?"""
+
+        with app.test_request_context(), \
+                patch.dict(passwords.settings, {'BCRYPT_POOL_SIZE': 1}):
+            passwords.init_app(app)
+            pw_hash = passwords.hash_password("TEST_PASSWORD")
+
+            broken = passwords._executor
+            os.kill(next(iter(broken._processes)), signal.SIGKILL)
+
+            with self.assertLogs('warbler.passwords', 'WARNING'):
+                self.assertTrue(passwords.check_password(pw_hash, "TEST_PASSWORD"))
 
+            self.assertIsNot(passwords._executor, broken)
+            self.assertTrue(passwords.check_password(pw_hash, "TEST_PASSWORD"))
 
+            # a pool that keeps breaking falls back to the caller
+            with patch('passwords.ProcessPoolExecutor.submit',
+                       side_effect=BrokenProcessPool("gone")):
+                self.assertTrue(passwords.check_password(pw_hash, "TEST_PASSWORD"))
 
+            passwords.init_app(app)
@@ -7,9 +7,11 @@
 
 import os
 from unittest import TestCase
-from flask import url_for
+from unittest.mock import patch
+from flask import g, url_for
 
-from models import db, connect_db, Message, User, Likes
+from models import db, connect_db, Message, User, Likes, Follows, Timeline
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -22,7 +24,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, profile_cards, follow_list_validator
+import current_user
+import query_stats
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -44,6 +48,8 @@ class UserViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
         Likes.query.delete()
+        current_user.clear()
+        profile_cards.clear()
 
         self.client = app.test_client()
 
@@ -179,6 +185,53 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("<p>@MrsTurtle</p>", html)
 
 
+    def test_users_search_ranking_and_paging(self):
+        """Test that search ranks exact, prefix then substring matches and pages through them."""
+
+        for username in ["turtle", "turtles_all", "seaturtle", "tur_tle"]:
+            User.signup(username=username, password="TEST_PASSWORD",
+                        email=f"{username}@test.com", image_url=None)
+        db.session.commit()
+
+        with patch('app.USERS_PER_PAGE', 2), app.test_client() as c:
+            resp = c.get('/users?q=Turtle')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index("<p>@turtle</p>"), html.index("<p>@turtles_all</p>"))
+            self.assertNotIn("<p>@seaturtle</p>", html)
+
+            next_page = html.split('class="btn btn-outline-primary">More users')[0]
+            next_page = next_page.rsplit('href="', 1)[1].split('"')[0].replace("&amp;", "&")
+
+            resp = c.get(next_page)
+            html = resp.get_data(as_text=True)
+
+            # substring matches come last; "_" is not a wildcard
+            self.assertIn("<p>@MrsTurtle</p>", html)
+            self.assertIn("<p>@seaturtle</p>", html)
+            self.assertNotIn("<p>@turtle</p>", html)
+            self.assertNotIn("<p>@tur_tle</p>", html)
+            self.assertNotIn("More users", html)
+
+            resp = c.get('/users?q=tur_')
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>@tur_tle</p>", html)
+            self.assertNotIn("<p>@turtle</p>", html)
+
+            # too short for the trigram index, but still matches substrings
+            resp = c.get('/users?q=ea')
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>@seaturtle</p>", html)
+
+            resp = c.get('/users?after=bogus')
+            self.assertEqual(resp.status_code, 400)
+
+            # tiers the search doesn't have: three with a term, one without
+            for query in ['q=sea&after=3:1:sea', 'q=sea&after=-1:1:sea', 'after=1:1:sea']:
+                resp = c.get(f'/users?{query}')
+                self.assertEqual(resp.status_code, 400, query)
+
     def test_users_id(self):
         """Test user detail page."""
 
@@ -188,6 +241,102 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("""<h4 id="sidebar-username">@testuser</h4>""", html)
 
+    def test_users_messages_pagination(self):
+        """Test that a profile pages through older messages with a cursor."""
+
+        for i in range(3):
+            db.session.add(Message(text=f"Message {i}",
+                                   timestamp=f"2020-01-0{i + 1} 00:00:00",
+                                   user_id=self.testuser.id))
+        db.session.commit()
+
+        with patch('app.MESSAGES_PER_PAGE', 2), app.test_client() as c:
+            resp = c.get(f'/users/{self.testuser.id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("<p>Message 2</p>", html)
+            self.assertNotIn("<p>Message 0</p>", html)
+
+            next_page = html.split('data-next-page="')[1].split('"')[0]
+            resp = c.get(next_page)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>Message 0</p>", html)
+            self.assertNotIn("<p>Message 1</p>", html)
+            self.assertNotIn('X-Next-Page', resp.headers)
+
+    def test_conditional_get(self):
+        """Test that unchanged profile and follow list pages answer 304."""
+
+        testuser_id = self.testuser.id
+        mrsturtle_id = self.mrsturtle.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = mrsturtle_id
+
+            c.post(f'/users/follow/{testuser_id}')
+
+            for url in [f'/users/{testuser_id}', f'/users/{mrsturtle_id}/following']:
+                resp = c.get(url)
+                etag = resp.headers['ETag']
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+                resp = c.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(resp.status_code, 304)
+                self.assertEqual(resp.get_data(), b'')
+
+            profile_etag = c.get(f'/users/{testuser_id}').headers['ETag']
+            following_etag = c.get(f'/users/{mrsturtle_id}/following').headers['ETag']
+
+            # a new message changes the profile; a profile edit changes the card
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post('/messages/new', data={"text": "Something new"})
+            c.post('/users/profile', data={"username": "testuser",
+                                           "email": "test@test.com",
+                                           "bio": "A new bio",
+                                           "password": "testuser"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = mrsturtle_id
+
+            resp = c.get(f'/users/{testuser_id}', headers={'If-None-Match': profile_etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>Something new</p>", resp.get_data(as_text=True))
+
+            resp = c.get(f'/users/{mrsturtle_id}/following',
+                         headers={'If-None-Match': following_etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("A new bio", resp.get_data(as_text=True))
+
+    def test_follow_list_validator_distinguishes_lists(self):
+        """Test that different lists with the same id sums get different validators."""
+
+        ids = []
+        for i in range(4):
+            user = User(username=f"listed{i}", email=f"listed{i}@test.com", password="HASHED")
+            db.session.add(user)
+            db.session.flush()
+            ids.append(user.id)
+
+        db.session.add(Follows(user_being_followed_id=ids[0], user_following_id=self.mrsturtle.id))
+        db.session.add(Follows(user_being_followed_id=ids[1], user_following_id=self.mrsturtle.id))
+        db.session.commit()
+
+        with app.test_request_context():
+            g.user = self.mrsturtle
+
+            outer = follow_list_validator(select([User.id]).where(User.id.in_([ids[0], ids[3]])))
+            inner = follow_list_validator(select([User.id]).where(User.id.in_([ids[1], ids[2]])))
+
+        self.assertNotEqual(outer[0], inner[0])
+        self.assertNotEqual(outer[1], inner[1])
+
     def test_user_follow_and_stop_following(self):
         """Test that a user can follow another user."""
         with app.test_client() as c:
@@ -219,8 +368,70 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("<p>@testuser</p>", html)
 
+    def test_follow_updates_timeline(self):
+        """Test that following copies messages into the timeline and unfollowing drops them."""
+
+        testuser_id = self.testuser.id
+        mrsturtle_id = self.mrsturtle.id
+
+        msg = Message(text="Timeline test", user_id=testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = mrsturtle_id
+
+            c.post(f'/users/follow/{testuser_id}')
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>Timeline test</p>", html)
+
+            c.post(f'/users/stop-following/{testuser_id}')
+
+            self.assertEqual(Timeline.query.filter_by(user_id=mrsturtle_id).all(), [])
+
     
 
+    def test_follow_like_and_delete_counters(self):
+        """Test that follow, like and delete routes keep user counters in step."""
+
+        testuser_id = self.testuser.id
+        mrsturtle_id = self.mrsturtle.id
+
+        msg = Message(text="Count my likes", user_id=testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = mrsturtle_id
+
+            c.post(f'/users/follow/{testuser_id}')
+            c.post(f'/users/add_like/{msg_id}')
+
+            resp = c.get(f'/users/{mrsturtle_id}')
+            html = resp.get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{mrsturtle_id}/following">1</a>', html)
+            self.assertIn(f'<a href="/users/{mrsturtle_id}/likes">1</a>', html)
+
+            resp = c.get(f'/users/{testuser_id}')
+            html = resp.get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{testuser_id}/followers">1</a>', html)
+
+            # deleting the followed user takes their follower and likes with them
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post('/users/delete')
+
+        mrsturtle = User.query.get(mrsturtle_id)
+        self.assertEqual(mrsturtle.following_count, 0)
+        self.assertEqual(mrsturtle.likes_count, 0)
+        self.assertEqual(User.reconcile_counts(), 0)
+
     def test_user_following_and_followers(self):
         """Test user following."""
         with app.test_client() as c:
@@ -286,6 +497,76 @@ class UserViewTestCase(TestCase):
 
 
 
+    def test_follow_list_refreshes_cards(self):
+        """Does a follow list show a profile edited in another process under its new ETag?"""
+
+        with app.test_client() as c:
+            c.post('/login', data={"username": "MrsTurtle", "password": "TEST_PASSWORD"})
+            c.post(f'/users/follow/{self.testuser.id}')
+
+            resp = c.get(f'/users/{self.mrsturtle.id}/following')
+            self.assertIn("<p>@testuser</p>", resp.get_data(as_text=True))
+
+            # as another worker would: this process's card isn't invalidated
+            User.query.filter_by(id=self.testuser.id).update(
+                {'username': 'renamed', 'profile_version': User.profile_version + 1},
+                synchronize_session=False)
+            db.session.commit()
+
+            resp = c.get(f'/users/{self.mrsturtle.id}/following',
+                         headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>@renamed</p>", resp.get_data(as_text=True))
+
+    def test_follow_lists_are_streamed(self):
+        """Test that follow lists stream, with the viewer's follow state per card."""
+
+        testuser_id = self.testuser.id
+        mrsturtle_id = self.mrsturtle.id
+
+        db.session.add(Follows(user_being_followed_id=mrsturtle_id,
+                               user_following_id=testuser_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f'/users/{testuser_id}/following')
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>@MrsTurtle</p>", html)
+            self.assertIn(f'action="/users/stop-following/{mrsturtle_id}"', html)
+
+            resp = c.get(f'/users/{mrsturtle_id}/followers')
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>@testuser</p>", html)
+            self.assertIn(f'action="/users/follow/{testuser_id}"', html)
+
+            resp = c.get('/users')
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("<p>@MrsTurtle</p>", resp.get_data(as_text=True))
+
+    def test_streamed_page_pops_flashes(self):
+        """Test that a flash shown on a streamed page is not shown again."""
+
+        testuser_id = self.testuser.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+                sess['_flashes'] = [('success', "Flashed once")]
+
+            resp = c.get(f'/users/{testuser_id}/following')
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("Flashed once", resp.get_data(as_text=True))
+
+            resp = c.get(f'/users/{testuser_id}')
+            self.assertNotIn("Flashed once", resp.get_data(as_text=True))
+
     def test_user_likes(self):
         """Test user liked messages."""
 
@@ -313,7 +594,9 @@ class UserViewTestCase(TestCase):
             data = resp.json
 
             self.assertEqual(resp.status_code, 200)
-            self.assertEqual({"message" : f"Message number {msg.id} liked"}, data)
+            self.assertEqual({"message" : f"Message number {msg.id} liked",
+                              "liked" : True,
+                              "likes" : 1}, data)
             
             # test that message appears in '/users/likes'
             resp = c.get(f'/users/{self.mrsturtle.id}/likes')
@@ -326,7 +609,9 @@ class UserViewTestCase(TestCase):
             data = resp.json
             
             self.assertEqual(resp.status_code, 200)
-            self.assertEqual({"message" : f"Message number {msg.id} unliked"}, data)
+            self.assertEqual({"message" : f"Message number {msg.id} unliked",
+                              "liked" : False,
+                              "likes" : 0}, data)
 
             resp = c.get(f'/users/{self.mrsturtle.id}/likes')
             html = resp.get_data(as_text=True)
@@ -414,6 +699,29 @@ class UserViewTestCase(TestCase):
             self.assertIn("""<h2 class="join-message">Welcome back.</h2>""", html)
 
 
+    def test_profile_edit_refreshes_current_user(self):
+        """Test that the cached current user is dropped when the profile changes."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mrsturtle.id
+
+            resp = c.get('/')
+            self.assertIn('alt="MrsTurtle"', resp.get_data(as_text=True))
+
+            data = {
+                "username": "MrsTortoise",
+                "email": "mrsturtle@test.com",
+                "password": "TEST_PASSWORD",
+                }
+
+            c.post('/users/profile', data=data)
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+            self.assertIn('alt="MrsTortoise"', html)
+            self.assertNotIn('alt="MrsTurtle"', html)
+
     def test_user_delete(self):
         """Test delete user."""
         
@@ -438,5 +746,48 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("""<h2 class="join-message">Welcome back.</h2>""", html)
 
+    def test_message_list_query_counts(self):
+        """Test that message lists load authors in batch, not once per message."""
+
+        testuser_id = self.testuser.id
+        mrsturtle_id = self.mrsturtle.id
+
+        authors = [testuser_id]
+        for i in range(3):
+            author = User.signup(username=f"author{i}", password="TEST_PASSWORD",
+                                 email=f"author{i}@test.com", image_url=None)
+            db.session.flush()
+            authors.append(author.id)
+
+        for i, author_id in enumerate(authors):
+            db.session.add(Message(text=f"Message {i}", user_id=author_id))
+            db.session.add(Follows(user_being_followed_id=author_id,
+                                   user_following_id=mrsturtle_id))
+        db.session.flush()
+
+        for msg in Message.query.all():
+            db.session.add(Likes(user_id=mrsturtle_id, message_id=msg.id))
+        Timeline.rebuild()
+        db.session.commit()
+
+        msg_id = Message.query.filter_by(user_id=testuser_id).one().id
+
+        pages = {
+            '/': 3,
+            f'/users/{testuser_id}': 5,
+            f'/users/{mrsturtle_id}/likes': 2,
+            f'/messages/{msg_id}': 2,
+        }
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = mrsturtle_id
+
+            # the current user's snapshot is cached after the first request
+            c.get('/')
 
+            for url, budget in pages.items():
+                resp = c.get(url)
 
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(query_stats.queries(resp.headers), budget, url)